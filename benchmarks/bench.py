@@ -0,0 +1,314 @@
+#!/usr/bin/env python2
+#
+# Benchmark sucklesync without a remote server: a synthetic "remote" tree is
+# generated locally, and [Local] ssh points at fake-ssh, which runs remote
+# commands directly on this host. Poll cycles are driven one at a time and the
+# results written out as JSON so runs can be compared, e.g.:
+#
+#   benchmarks/bench.py --directories 500 --files 20 --cycles 5 --churn 0.05 --output before.json
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from sucklesync import sucklesync
+from sucklesync.utils import process
+
+FAKE_SSH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake-ssh")
+SIZES = ("fixed", "uniform", "exponential")
+BLOCK = 65536
+
+CONFIGURATION = """[Local]
+rsync = %(rsync)s
+rsync_flags = -a --verbose
+ssh = %(ssh)s
+delete = yes
+multiplex = yes
+control_directory = %(directory)s
+
+[Remote]
+hostname = localhost
+find = %(find)s
+active_window = %(active_window)d
+ssh_timeout = 60
+agent = %(agent)s
+agent_python = %(python)s
+
+[Sucklepaths]
+source1 = %(directory)s/remote
+destination1 = %(directory)s/local
+
+[Logging]
+filename = %(directory)s/sucklesync.log
+pidfile = %(directory)s/sucklesync.pid
+level = %(level)s
+
+[Frequency]
+; Polls are only started by the benchmark, once per cycle.
+minimum_poll_delay = 86400
+maximum_poll_delay = 86400
+jitter = 0
+
+[Transfer]
+workers = %(workers)d
+policy = %(policy)s
+"""
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark sucklesync against a synthetic local tree")
+    parser.add_argument("--directories", type=int, default=100, help="top-level directories in the remote tree")
+    parser.add_argument("--files", type=int, default=10, help="files per directory")
+    parser.add_argument("--depth", type=int, default=1, help="nest each directory's files this many levels deep")
+    parser.add_argument("--size", type=int, default=4096, help="mean file size in bytes")
+    parser.add_argument("--size-distribution", choices=SIZES, default="fixed", help="distribution of file sizes around the mean")
+    parser.add_argument("--age", type=int, default=86400, help="spread file modification times over this many seconds")
+    parser.add_argument("--active", type=float, default=0.0, help="fraction of directories still being written to")
+    parser.add_argument("--active-window", type=int, default=60, help="[Remote] active_window")
+    parser.add_argument("--churn", type=float, default=0.0, help="fraction of directories changed before each cycle after the first")
+    parser.add_argument("--cycles", type=int, default=3, help="poll cycles to run")
+    parser.add_argument("--workers", type=int, default=1, help="[Transfer] workers")
+    parser.add_argument("--policy", default="fifo", help="[Transfer] policy")
+    parser.add_argument("--manifest", action="store_true", help="enable the [State] manifest")
+    parser.add_argument("--agent", action="store_true", help="scan with the remote agent instead of find")
+    parser.add_argument("--rsync", default="/usr/bin/rsync", help="path to rsync")
+    parser.add_argument("--find", default="/usr/bin/find", help="path to find")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed generates the same tree")
+    parser.add_argument("--directory", help="work in this directory instead of a temporary one")
+    parser.add_argument("--keep", action="store_true", help="don't remove the work directory afterwards")
+    parser.add_argument("--output", "-o", help="write results to this file instead of stdout")
+    parser.add_argument("--verbose", "-v", action="count", help="show sucklesync's log output")
+    return parser.parse_args()
+
+def file_size(rng, args):
+    if args.size_distribution == "uniform":
+        return rng.randint(0, 2 * args.size)
+    elif args.size_distribution == "exponential":
+        return int(rng.expovariate(1.0 / args.size)) if args.size else 0
+    return args.size
+
+def write_file(path, size, rng, data, mtime):
+    with open(path, "wb") as f:
+        while size > 0:
+            offset = rng.randint(0, BLOCK)
+            chunk = data[offset:offset + min(size, BLOCK)]
+            f.write(chunk)
+            size -= len(chunk)
+    os.utime(path, (mtime, mtime))
+
+# Fill one top-level directory, returning the number of bytes written. Active
+# directories get one file modified just now, everything else is old enough
+# to transfer.
+def generate_directory(path, rng, data, args, now, active):
+    parent = path
+    for level in range(args.depth - 1):
+        parent = os.path.join(parent, "level%d" % level)
+    os.makedirs(parent)
+
+    ready = now - 2 * args.active_window
+    total = 0
+    for number in range(args.files):
+        size = file_size(rng, args)
+        mtime = ready - rng.uniform(0, args.age)
+        if active and number == 0:
+            mtime = now
+        write_file(os.path.join(parent, "file%d" % number), size, rng, data, mtime)
+        total += size
+
+    # Creating the files just updated the directories' own mtimes.
+    mtime = ready - rng.uniform(0, args.age)
+    while True:
+        os.utime(parent, (mtime, mtime))
+        if parent == path:
+            break
+        parent = os.path.dirname(parent)
+    return total
+
+def generate_tree(root, rng, data, args):
+    now = time.time()
+    active = set(rng.sample(range(args.directories), int(args.directories * args.active)))
+    total = 0
+    for number in range(args.directories):
+        total += generate_directory(os.path.join(root, "directory%d" % number), rng, data, args, now, number in active)
+    return total
+
+# Rewrite one file in a fraction of the directories, dating the change far
+# enough back that the directories are ready to transfer again.
+def churn(root, rng, data, args):
+    changed = 0
+    total = 0
+    count = int(args.directories * args.churn)
+    mtime = time.time() - 2 * args.active_window
+    for number in rng.sample(range(args.directories), count):
+        parent = os.path.join(root, "directory%d" % number)
+        for level in range(args.depth - 1):
+            parent = os.path.join(parent, "level%d" % level)
+        size = file_size(rng, args)
+        write_file(os.path.join(parent, "file0"), size, rng, data, mtime)
+        changed += 1
+        total += size
+    return changed, total
+
+# Sum a metric over all of its labels.
+def total(metric, field = None):
+    values = metric.values.values()
+    if field:
+        return sum(value[field] for value in values)
+    return sum(values)
+
+def snapshot(ss):
+    times = os.times()
+    return {
+        "time": time.time(),
+        "cpu": times[0] + times[1],
+        "children_cpu": times[2] + times[3],
+        "processes": dict(process.spawned),
+        "scan_seconds": total(ss.stats["scan_duration"], "sum"),
+        "scans": total(ss.stats["scan_duration"], "count"),
+        "scan_bytes": total(ss.stats["scan_received"]),
+        "transfer_seconds": total(ss.stats["transfer_duration"], "sum"),
+        "transfers": total(ss.stats["transfer_duration"], "count"),
+        "ssh_seconds": total(ss.stats["ssh_duration"], "sum"),
+        "received_bytes": total(ss.stats["received"]),
+        "errors": total(ss.stats["errors"]),
+    }
+
+def difference(before, after):
+    cycle = {
+        "seconds": after["time"] - before["time"],
+        "cpu_seconds": after["cpu"] - before["cpu"],
+        "children_cpu_seconds": after["children_cpu"] - before["children_cpu"],
+        "processes": dict((name, count - before["processes"].get(name, 0)) for name, count in after["processes"].iteritems() if count != before["processes"].get(name, 0)),
+    }
+    for name in ("scan_seconds", "scans", "scan_bytes", "transfer_seconds", "transfers", "ssh_seconds", "received_bytes", "errors"):
+        cycle[name] = after[name] - before[name]
+    cycle["bytes_per_second"] = cycle["received_bytes"] / cycle["seconds"] if cycle["seconds"] else 0
+    return cycle
+
+def load(path, args):
+    ss = sucklesync.SuckleSync(path)
+    ss.verbose = args.verbose or False
+    ss.daemonize = False
+    ss._load_debugger()
+    ss._load_configuration()
+    ss._enable_debugger()
+    sucklesync.sucklesync.sucklesync_instance = ss
+    return ss
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    args = parse_arguments()
+    for program in (args.rsync, args.find):
+        if not os.access(program, os.X_OK):
+            sys.exit("%s not found, set its path with --rsync or --find" % program)
+
+    directory = args.directory or tempfile.mkdtemp(prefix="sucklesync-bench-")
+    directory = os.path.abspath(directory)
+    remote = os.path.join(directory, "remote")
+    local = os.path.join(directory, "local")
+    try:
+        for path in (remote, local):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+
+        rng = random.Random(args.seed)
+        data = "".join(chr(rng.randint(0, 255)) for i in range(2 * BLOCK))
+        started = time.time()
+        generated = generate_tree(remote, rng, data, args)
+        generate_seconds = time.time() - started
+
+        path = os.path.join(directory, "sucklesync.cfg")
+        with open(path, "w") as f:
+            f.write(CONFIGURATION % {
+                "rsync": args.rsync,
+                "find": args.find,
+                "ssh": FAKE_SSH,
+                "directory": directory,
+                "active_window": args.active_window,
+                "level": "DEBUG" if args.verbose else "WARNING",
+                "workers": args.workers,
+                "policy": args.policy,
+                "agent": "yes" if args.agent else "no",
+                "python": sys.executable,
+            })
+            if args.manifest:
+                f.write("\n[State]\nmanifest = %s\n" % os.path.join(directory, "manifest.db"))
+
+        ss = load(path, args)
+        sucklesync._prepare()
+        cycles = []
+        try:
+            for number in range(args.cycles):
+                changed = (0, 0)
+                if number and args.churn:
+                    changed = churn(remote, rng, data, args)
+                for key in range(len(ss.paths["source"])):
+                    ss.polls.poll_now(key)
+
+                before = snapshot(ss)
+                sucklesync._poll()
+                cycle = difference(before, snapshot(ss))
+                cycle["changed_directories"], cycle["changed_bytes"] = changed
+                cycle["phases"] = ss.profiler.last["phases"]
+                cycles.append(cycle)
+        finally:
+            sucklesync._shutdown()
+
+        steady = cycles[1:]
+        results = {
+            "parameters": vars(args),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.sysconf("SC_NPROCESSORS_ONLN"),
+            },
+            "tree": {
+                "directories": args.directories,
+                "files": args.directories * args.files,
+                "bytes": generated,
+                "generate_seconds": generate_seconds,
+            },
+            "cycles": cycles,
+            "summary": {
+                "initial_sync_seconds": cycles[0]["seconds"] if cycles else None,
+                "initial_bytes_per_second": cycles[0]["bytes_per_second"] if cycles else None,
+                "steady_median_seconds": median([cycle["seconds"] for cycle in steady]),
+                "steady_median_scan_seconds": median([cycle["scan_seconds"] for cycle in steady]),
+                "steady_median_scan_bytes": median([cycle["scan_bytes"] for cycle in steady]),
+                "rsync_processes": sum(cycle["processes"].get(os.path.basename(args.rsync), 0) for cycle in cycles),
+                "ssh_processes": sum(cycle["processes"].get(os.path.basename(FAKE_SSH), 0) for cycle in cycles),
+                "errors": sum(cycle["errors"] for cycle in cycles),
+                "peak_rss_kilobytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            },
+        }
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+        else:
+            print output
+
+    finally:
+        if not args.keep and not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -19,5 +19,5 @@ setup(name="sucklesync",
       scripts=["bin/sucklesync"],
       download_url = "https://github.com/jeremyandrews/sucklesync/archive/v0.3.8-alpha.tar.gz",
       include_package_data=True,
-      install_requires=["daemonize>=2.4.7", "pyzmail", "easyprocess"],
+      install_requires=["daemonize>=2.4.7", "pyzmail"],
      )
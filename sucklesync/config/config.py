@@ -6,14 +6,16 @@ import sys
 config_instance = None
 
 class Config:
-    def __init__(self, debugger):
+    def __init__(self, debugger, filenames = None):
         from sucklesync import sucklesync
         self.parser = ConfigParser.ConfigParser()
         self.debugger = debugger
-        self.found = self.parser.read(sucklesync.DEFAULT_CONFIG)
+        self.found = self.parser.read(filenames or sucklesync.DEFAULT_CONFIG)
 
     def _GetValue(self, section, option, value, default, required, secret):
-        if not value and default:
+        # only missing or empty values are replaced, an explicit "no" or 0 must
+        # not be replaced by the default
+        if (value is None or value == "" or value == []) and default is not None:
             value = default
 
         if required and not value and value != False:
@@ -168,6 +170,26 @@ class Config:
         except Exception as e:
             self.debugger.dump_exception("GetItems() exception while reading configuration")
 
+    # Read optional numbered options (key1, key2, ...) that accompany the pairs
+    # loaded by GetItemPairs, returning one value per pair.
+    def GetItemList(self, section, key, count, default = None, cast = str):
+        try:
+            values = []
+            for index in range(1, count + 1):
+                option = "%s%d" % (key, index)
+                if (self.parser.has_section(section) and self.parser.has_option(section, option)):
+                    try:
+                        value = cast(self.parser.get(section, option))
+                    except ValueError:
+                        self.debugger.error("ignoring invalid [%s] '%s'", (section, option))
+                        value = default
+                else:
+                    value = default
+                values.append(self._GetValue(section, option, value, default, False, False))
+            return values
+        except Exception as e:
+            self.debugger.dump_exception("GetItemList() exception while reading configuration")
+
 # Perform simplistic email address validation.
 def valid_email_address(address):
     try:
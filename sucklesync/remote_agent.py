@@ -0,0 +1,218 @@
+"""
+    The sucklesync remote agent. It's sent to the remote server over ssh and
+    run there by whatever python is available (2.6 or later, or 3), so it only
+    uses the standard library and doesn't import the rest of sucklesync.
+
+    Requests and replies are frames on stdin and stdout: a 4 byte big-endian
+    length, then a zlib compressed JSON object. Paths are sent as latin-1 text
+    so that any bytes survive the trip. Run it locally to try the protocol:
+
+        python sucklesync/remote_agent.py
+"""
+
+import json
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
+
+VERSION = 3
+HEADER = struct.Struct(">I")
+MAX_FRAME = 256 * 1024 * 1024
+
+def write_frame(stream, message):
+    data = zlib.compress(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+    stream.write(HEADER.pack(len(data)) + data)
+    stream.flush()
+    return HEADER.size + len(data)
+
+# Returns (message, size in bytes), or (None, 0) at the end of the stream.
+def read_frame(stream):
+    header = _read(stream, HEADER.size)
+    if not header:
+        return None, 0
+    length = HEADER.unpack(header)[0]
+    if length > MAX_FRAME:
+        raise ValueError("frame of %d bytes is too large" % length)
+    data = _read(stream, length)
+    if data is None:
+        raise EOFError("stream ended in the middle of a frame")
+    return json.loads(zlib.decompress(data).decode("utf-8")), HEADER.size + length
+
+def _read(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def encode_path(path):
+    return path.decode("latin-1")
+
+def decode_path(text):
+    return text.encode("latin-1")
+
+# Summarize one top-level entry of a source the way the daemon summarizes the
+# output of find: the most recent modification time of anything in it, the
+# total size and number of its regular files, and whether it holds a file
+# named marker or lock. Symbolic links aren't followed. Returns
+# ([mtime, size, files, marker, locked], entries, complete).
+def summarize(path, marker = None, lock = None):
+    status = os.lstat(path)
+    summary = [status.st_mtime, 0, 0, False, False]
+    if stat.S_ISREG(status.st_mode):
+        return [status.st_mtime, status.st_size, 1, False, False], 1, True
+    if not stat.S_ISDIR(status.st_mode):
+        return summary, 1, True
+
+    for index, name in ((3, marker), (4, lock)):
+        if name and os.path.lexists(os.path.join(path, name)):
+            summary[index] = True
+
+    entries = 1
+    errors = []
+    for root, directories, files in os.walk(path, onerror=errors.append):
+        for name in directories + files:
+            try:
+                status = os.lstat(os.path.join(root, name))
+            except OSError as e:
+                errors.append(e)
+                continue
+            entries += 1
+            if status.st_mtime > summary[0]:
+                summary[0] = status.st_mtime
+            if stat.S_ISREG(status.st_mode):
+                summary[1] += status.st_size
+                summary[2] += 1
+    return summary, entries, not errors
+
+# What the agent knows about one source: the summary of every top-level entry,
+# and the generation in which each last changed or disappeared.
+class Tree:
+    def __init__(self, source):
+        self.source = source
+        self.summaries = {}
+        self.changed = {}
+        self.lock = threading.Lock()
+
+    # Walk the source (or only the listed directories), recording what changed
+    # in this generation. Returns (entries, complete).
+    def update(self, generation, directories = None, marker = None, lock = None):
+        names = [name for name in os.listdir(self.source) if not name.startswith(b".")]
+        if directories is not None:
+            names = [name for name in names if name in directories]
+            gone = [name for name in directories if name in self.summaries and name not in names]
+        else:
+            gone = [name for name in self.summaries if name not in names]
+
+        entries = 1
+        complete = True
+        for name in names:
+            try:
+                summary, walked, walked_all = summarize(os.path.join(self.source, name), marker, lock)
+            except OSError:
+                complete = False
+                continue
+            entries += walked
+            complete = complete and walked_all
+            if self.summaries.get(name) != summary:
+                self.summaries[name] = summary
+                self.changed[name] = generation
+        for name in gone:
+            del self.summaries[name]
+            self.changed[name] = generation
+        return entries, complete
+
+    # What changed after generation since (everything if since is None), as
+    # ({name: summary}, [removed names]).
+    def changes(self, since):
+        if since is None:
+            return dict(self.summaries), []
+        changed = {}
+        removed = []
+        for name, generation in list(self.changed.items()):
+            if name in self.summaries:
+                if generation > since:
+                    changed[name] = self.summaries[name]
+            elif generation > since:
+                removed.append(name)
+            else:
+                # The daemon has seen the removal, forget it.
+                del self.changed[name]
+        return changed, removed
+
+class Agent:
+    def __init__(self, output):
+        self.output = output
+        self.trees = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def handle(self, request):
+        operation = request.get("op")
+        try:
+            if operation == "hello":
+                reply = {"version": VERSION, "python": sys.version.split()[0]}
+            elif operation == "summaries":
+                reply = self.summaries(request)
+            else:
+                reply = {"error": "unknown operation: %s" % operation}
+        except Exception as e:
+            # Always reply, so the daemon isn't left waiting.
+            reply = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        reply["id"] = request.get("id")
+        with self.lock:
+            write_frame(self.output, reply)
+
+    # Summaries of the top-level entries of a source that changed since the
+    # generation of an earlier reply, and those that have disappeared.
+    def summaries(self, request):
+        source = decode_path(request["source"])
+        directories = request.get("directories")
+        if directories is not None:
+            directories = set(decode_path(name) for name in directories)
+        marker, lock = [request.get(name) and decode_path(request[name]) for name in ("marker", "lock")]
+
+        with self.lock:
+            tree = self.trees.get(source)
+            if tree is None:
+                tree = self.trees[source] = Tree(source)
+            self.generation += 1
+            generation = self.generation
+
+        with tree.lock:
+            # The daemon compares modification times against this clock.
+            now = time.time()
+            entries, complete = tree.update(generation, directories, marker, lock)
+            changed, removed = tree.changes(request.get("since"))
+        return {
+            "generation": generation,
+            "now": now,
+            "entries": entries,
+            "complete": complete,
+            "changed": dict((encode_path(name), summary) for name, summary in changed.items()),
+            "removed": [encode_path(name) for name in removed],
+        }
+
+# Answer requests until stdin is closed. Each request is handled in its own
+# thread, so a slow walk doesn't hold up the others; replies carry the id of
+# their request.
+def main():
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    agent = Agent(stdout)
+    while True:
+        request, size = read_frame(stdin)
+        if request is None or request.get("op") == "quit":
+            break
+        thread = threading.Thread(target=agent.handle, args=(request,))
+        thread.daemon = True
+        thread.start()
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,29 @@
     SuckleSync - A wrapper around rsync to simplify continuous synchronization of remote directories.
 """
 
+import collections
 import logging
-from easyprocess import EasyProcess
+import re
 
 import sucklesync
+from utils import agent
+from utils import bandwidth
+from utils import connection
+from utils import control
 from utils import debug
 from utils import email
+from utils import fingerprints
+from utils import journal
+from utils import lease
+from utils import manifest
+from utils import metrics
+from utils import poll_scheduler
+from utils import pool
+from utils import process
+from utils import profiler
+from utils import scan
+from utils import transfer_queue
+from utils import watch
 from config import config
 
 sucklesync_instance = None
@@ -17,6 +34,27 @@ DEFAULT_LOGLEVEL  = logging.WARNING
 DEFAULT_LOGFILE   = "/var/log/sucklesync/sucklesync.log"
 DEFAULT_LOGFORMAT = "%(asctime)s [%(levelname)s/%(processName)s] %(message)s"
 DEFAULT_PIDFILE   = "/var/run/sucklesync.pid"
+DEFAULT_CONTROL_DIRECTORY = "~/.ssh/sucklesync"
+DEFAULT_WATCH_COMMAND = "/usr/bin/inotifywait --monitor --recursive --quiet --event close_write,create,delete,moved_to,moved_from,attrib --format %w%f"
+
+RSYNC_FILE_LIST = re.compile("receiving(.*)file list")
+RSYNC_SENT      = re.compile("sent (.*) bytes")
+RSYNC_RECEIVED  = re.compile("received ([0-9,.]+)([KMGTP]?) bytes")
+FIND_WILDCARDS  = re.compile(r"[][*?\\]")
+PARTIAL_DIR     = ".sucklesync-partial"
+SHA1SUM_LINE    = re.compile(r"([0-9a-f]{40})  \./(.*)")
+DEDUP_MODES     = ("link", "copy")
+READINESS       = ("window", "stable")
+
+# Options that change how the remote hosts are reached. Reloading a change to
+# any of the [Local] options replaces the master connection to every host, a
+# change to those of a host only replaces its own.
+CONNECTION_OPTIONS = ("ssh", "ssh_flags", "multiplex", "control_directory", "multiplex_keepalive")
+HOST_OPTIONS = ("hostname", "port", "username", "ssh_flags")
+# Configuration that is only read when sucklesync starts, as (section, options
+# or None for all of them).
+RESTART_OPTIONS = (("Logging", ("filename", "pidfile", "json")), ("Metrics", None), ("Profiling", None), ("State", ("leases", "lease_duration", "instance", "control")), ("Dedup", None))
+RSYNC_PROGRESS  = re.compile(r"\s*([0-9,]+)\s+([0-9]+)%\s+(\S+)\s+([0-9]+:[0-9]+:[0-9]+)")
 
 class SuckleSync:
     def __init__(self, config):
@@ -27,6 +65,56 @@ class SuckleSync:
         self.logging = {}
         self.frequency = {}
         self.mail = {}
+        self.monitoring = {}
+        self.transfer = {}
+        self.bandwidth = {}
+        self.progress = {}
+        self.cleaned = {}
+        self.watchers = {}
+        self.swept = {}
+        # The latest summary signature of each directory of each sucklepath,
+        # and how many scans in a row it has been seen unchanged.
+        self.stability = {}
+        self.state = {}
+        self.hosts = {}
+        self.connections = {}
+        self.agents = {}
+        # The number of scans and transfers running on each host.
+        self.scanning = collections.Counter()
+        self.transferring = collections.Counter()
+        self.manifest = None
+        self.journal = None
+        self.leases = None
+        self.dedup = {}
+        self.fingerprints = None
+        self.in_flight = {}
+        # The sucklepaths being polled, by key: when their poll started, how
+        # far it got ("waiting" for a scan, "scanning", "scanned" while their
+        # directories are transferred, "cleaning"), and what it found.
+        self.polling = {}
+        # The keys of the sucklepaths waiting for a scan, most overdue first.
+        self.waiting = []
+        self.reload = False
+        self.reloaded = None
+        self.exporter = None
+        self.control = None
+        self.profiling = {}
+        self.profiler = profiler.Profiler()
+        self._load_metrics()
+
+    def _load_metrics(self):
+        self.metrics = metrics.Registry()
+        self.stats = {
+            "received": self.metrics.counter("sucklesync_received_bytes_total", "Bytes received by rsync.", ("sucklepath",)),
+            "transfers": self.metrics.counter("sucklesync_transfers_total", "Directory transfers completed.", ("sucklepath", "result")),
+            "transfer_duration": self.metrics.histogram("sucklesync_transfer_duration_seconds", "Time taken to transfer one directory.", ("sucklepath",)),
+            "scan_duration": self.metrics.histogram("sucklesync_scan_duration_seconds", "Time taken to scan a sucklepath on the remote server.", ("sucklepath",)),
+            "scan_received": self.metrics.counter("sucklesync_scan_received_bytes_total", "Bytes of scan results received from the remote server.", ("sucklepath",)),
+            "ssh_duration": self.metrics.histogram("sucklesync_ssh_command_duration_seconds", "Time taken by remote commands run over ssh."),
+            "queue_depth": self.metrics.gauge("sucklesync_queue_depth", "Directories waiting to be transferred.", ("sucklepath",)),
+            "errors": self.metrics.counter("sucklesync_errors_total", "Failed ssh, rsync and remote agent commands.", ("command",)),
+            "leases": self.metrics.gauge("sucklesync_leases_held", "Sucklepaths this instance holds the lease of."),
+        }
 
     def _load_debugger(self):
         import logging.handlers
@@ -54,17 +142,22 @@ class SuckleSync:
             formatter = logging.Formatter(DEFAULT_LOGFORMAT)
             self.debugger.handler.setFormatter(formatter)
             self.logger.addHandler(self.debugger.handler)
-            self.logger.setLevel(self.logging["level"])
+            self.debugger.setLevel(self.logging["level"])
+            if self.logging["json"]:
+                self.debugger.logToJson(self.logging["json"])
         except Exception as e:
             self.debugger.dump_exception("_enable_debugger() exception")
 
     def _load_configuration(self):
+        import os
+        import re
+
         try:
             from shlex import quote as cmd_quote
         except ImportError:
             from pipes import quote as cmd_quote
 
-        self.configuration = config.Config(self.debugger)
+        self.configuration = config.Config(self.debugger, self.config)
 
         # load binary paths and associated flags
         self.local["rsync"] = cmd_quote(self.configuration.GetText("Local", "rsync", "/usr/bin/rsync"))
@@ -72,26 +165,141 @@ class SuckleSync:
         self.local["ssh"] = cmd_quote(self.configuration.GetText("Local", "ssh", "/usr/bin/ssh"))
         self.local["ssh_flags"] = self.configuration.GetText("Local", "ssh_flags", "-C")
         self.local["delete"] = self.configuration.GetBoolean("Local", "delete")
+        self.local["delete_interval"] = self.configuration.GetInt("Local", "delete_interval", 3600, False)
+        self.local["multiplex"] = self.configuration.GetBoolean("Local", "multiplex", True, False)
+        self.local["multiplex_keepalive"] = self.configuration.GetInt("Local", "multiplex_keepalive", 30, False)
+        self.local["control_directory"] = os.path.expanduser(self.configuration.GetText("Local", "control_directory", DEFAULT_CONTROL_DIRECTORY, False))
         self.remote["find"] = cmd_quote(self.configuration.GetText("Remote", "find", "/usr/bin/find"))
-        self.remote["find_flags"] = cmd_quote(self.configuration.GetText("Remote", "find_flags", "-mmin -10 -print"))
+        self.remote["find_flags"] = self.configuration.GetText("Remote", "find_flags", "-mmin -10 -print", False)
+
+        # directories modified within active_window seconds are still changing,
+        # older configurations expressed this as "-mmin -N" in find_flags
+        active_window = 600
+        match = re.search(r"-mmin\s+-?([0-9]+)", self.remote["find_flags"])
+        if match:
+            active_window = int(match.group(1)) * 60
+        self.remote["active_window"] = self.configuration.GetInt("Remote", "active_window", active_window, False)
+        ignored = re.sub(r"-mmin\s+-?[0-9]+|-print\b", "", self.remote["find_flags"]).strip()
+        if ignored:
+            self.debugger.warning("ignoring [Remote] 'find_flags' other than -mmin (%s), directories are summarized with -printf", (ignored,))
+
+        # with "stable" readiness, a directory is also ready once its summary
+        # is unchanged for stable_scans scans in a row; a directory holding
+        # the marker file is ready right away, one holding the lock file never
+        self.remote["readiness"] = self.configuration.GetText("Remote", "readiness", "window", False)
+        if not self.remote["readiness"] in READINESS:
+            self.debugger.warning("ignoring invalid readiness (%s), must be one of: %s", (self.remote["readiness"], ", ".join(READINESS)))
+            self.remote["readiness"] = "window"
+        self.remote["stable_scans"] = max(2, self.configuration.GetInt("Remote", "stable_scans", 2, False))
+        self.remote["marker"] = self.configuration.GetText("Remote", "marker", None, False)
+        self.remote["lock"] = self.configuration.GetText("Remote", "lock", None, False)
+
+        # optionally follow changes as they happen rather than walking the
+        # whole source on every poll
+        self.remote["watch"] = self.configuration.GetBoolean("Remote", "watch", False, False)
+        self.remote["watch_command"] = self.configuration.GetText("Remote", "watch_command", DEFAULT_WATCH_COMMAND, False)
 
         # load SSH configuration
-        self.remote["hostname"] = self.configuration.GetText("Remote", "hostname")
+        self.remote["hostname"] = self.configuration.GetText("Remote", "hostname", None, False)
         self.remote["port"] = self.configuration.GetInt("Remote", "port", 22, False)
         self.remote["ssh_timeout"] = self.configuration.GetInt("Remote", "ssh_timeout", 5, False)
+
+        # sucklepaths are scanned concurrently, giving up on scans that take
+        # longer than scan_timeout seconds
+        self.remote["scans"] = self.configuration.GetInt("Remote", "scans", 4, False)
+        self.remote["scan_timeout"] = self.configuration.GetInt("Remote", "scan_timeout", 3600, False)
         self.remote["username"] = self.configuration.GetText("Remote", "username", False, False)
 
+        # optionally scan with a long-lived agent on the remote server rather
+        # than running find every time
+        self.remote["agent"] = self.configuration.GetBoolean("Remote", "agent", False, False)
+        self.remote["agent_python"] = self.configuration.GetText("Remote", "agent_python", "python", False)
+
         # load paths that will be suckle-synced
         self.paths = self.configuration.GetItemPairs("Sucklepaths", ["source", "destination"])
+        if self.paths:
+            weights = self.configuration.GetItemList("Sucklepaths", "weight", len(self.paths["source"]), 1.0, float)
+            self.paths["weight"] = []
+            for key, weight in enumerate(weights):
+                if weight <= 0:
+                    self.debugger.warning("ignoring invalid [Sucklepaths] 'weight%d' (%s), must be greater than 0", (key + 1, weight))
+                    weight = 1.0
+                self.paths["weight"].append(weight)
+
+            # per-sucklepath overrides of [Frequency] poll delays
+            self.paths["minimum_poll_delay"] = self.configuration.GetItemList("Sucklepaths", "minpoll", len(self.paths["source"]), None, int)
+            self.paths["maximum_poll_delay"] = self.configuration.GetItemList("Sucklepaths", "maxpoll", len(self.paths["source"]), None, int)
+
+        # load local state preferences
+        self.state["manifest"] = self.configuration.GetText("State", "manifest", None, False)
+        self.state["journal"] = self.configuration.GetText("State", "journal", None, False)
+        self.state["journal_interval"] = self.configuration.GetInt("State", "journal_interval", 10, False)
+        self.state["leases"] = self.configuration.GetText("State", "leases", None, False)
+        self.state["lease_duration"] = max(3, self.configuration.GetInt("State", "lease_duration", 60, False))
+        self.state["instance"] = self.configuration.GetText("State", "instance", None, False)
+        self.state["control"] = self.configuration.GetText("State", "control", None, False)
+
+        # load metrics preferences
+        self.monitoring["address"] = self.configuration.GetText("Metrics", "address", "127.0.0.1", False)
+        self.monitoring["port"] = self.configuration.GetInt("Metrics", "port", None, False)
+        self.monitoring["json"] = self.configuration.GetText("Metrics", "json", None, False)
+
+        # optional per-cycle profiling
+        self.profiling["log"] = self.configuration.GetText("Profiling", "log", None, False)
+        self.profiling["cprofile"] = self.configuration.GetText("Profiling", "cprofile", None, False)
+        self.profiling["cprofile_count"] = self.configuration.GetInt("Profiling", "cprofile_count", 5, False)
 
         # load logging preferences
         self.logging["filename"] = self.configuration.GetText("Logging", "filename", DEFAULT_LOGFILE, False)
         self.logging["pidfile"] = self.configuration.GetText("Logging", "pidfile", DEFAULT_PIDFILE, False)
         self.logging["level"] = self.configuration.GetText("Logging", "level", DEFAULT_LOGLEVEL, False)
+        self.logging["json"] = self.configuration.GetText("Logging", "json", None, False)
 
         # load frequency preferences
         self.frequency["minimum_poll_delay"] = self.configuration.GetInt("Frequency", "minimum_poll_delay", 60, False)
         self.frequency["maximum_poll_delay"] = self.configuration.GetInt("Frequency", "maximum_poll_delay", 60, False)
+        self.frequency["sweep_delay"] = self.configuration.GetInt("Frequency", "sweep_delay", 3600, False)
+        self.frequency["jitter"] = self.configuration.GetInt("Frequency", "jitter", 10, False)
+        if self.paths:
+            for key in range(len(self.paths["source"])):
+                if self.paths["minimum_poll_delay"][key] is None:
+                    self.paths["minimum_poll_delay"][key] = self.frequency["minimum_poll_delay"]
+                if self.paths["maximum_poll_delay"][key] is None:
+                    self.paths["maximum_poll_delay"][key] = self.frequency["maximum_poll_delay"]
+
+        # load transfer preferences
+        self.transfer["workers"] = self.configuration.GetInt("Transfer", "workers", 1, False)
+        self.transfer["progress"] = self.configuration.GetBoolean("Transfer", "progress", False, False)
+        self.transfer["policy"] = self.configuration.GetText("Transfer", "policy", transfer_queue.FIFO, False)
+        self.transfer["partial"] = self.configuration.GetBoolean("Transfer", "partial", True, False)
+
+        # directories of up to batch_size bytes are transferred together, up
+        # to batch_count directories or batch_bytes bytes per rsync
+        self.transfer["batch_size"] = self.configuration.GetInt("Transfer", "batch_size", 0, False)
+        self.transfer["batch_count"] = max(1, self.configuration.GetInt("Transfer", "batch_count", 100, False))
+        self.transfer["batch_bytes"] = self.configuration.GetInt("Transfer", "batch_bytes", 104857600, False)
+
+        # one bandwidth budget, in KB per second, shared by all transfers
+        try:
+            self.bandwidth["schedule"] = bandwidth.Schedule(self.configuration.GetText("Bandwidth", "schedule", None, False), self.configuration.GetInt("Bandwidth", "limit", 0, False))
+        except ValueError as e:
+            self.debugger.critical("invalid [Bandwidth] schedule: %s", (e,))
+        self.bandwidth["minimum_share"] = self.configuration.GetInt("Bandwidth", "minimum_share", 32, False)
+        if not self.transfer["policy"] in transfer_queue.POLICIES:
+            self.debugger.warning("ignoring invalid transfer policy (%s), must be one of: %s", (self.transfer["policy"], ", ".join(transfer_queue.POLICIES)))
+            self.transfer["policy"] = transfer_queue.FIFO
+
+        # optionally link (or copy) files already under any destination
+        # rather than transferring them again
+        self.dedup["index"] = self.configuration.GetText("Dedup", "index", None, False)
+        self.dedup["mode"] = self.configuration.GetText("Dedup", "mode", "link", False)
+        self.dedup["hash"] = self.configuration.GetBoolean("Dedup", "hash", False, False)
+        self.dedup["minimum_size"] = self.configuration.GetInt("Dedup", "minimum_size", 1048576, False)
+        # rsync accepts at most 20 --link-dest or --copy-dest directories
+        self.dedup["candidates"] = min(20, max(1, self.configuration.GetInt("Dedup", "candidates", 3, False)))
+        if not self.dedup["mode"] in DEDUP_MODES:
+            self.debugger.warning("ignoring invalid dedup mode (%s), must be one of: %s", (self.dedup["mode"], ", ".join(DEDUP_MODES)))
+            self.dedup["mode"] = "link"
 
         # load email preferences
         self.mail["enabled"] = self.configuration.GetBoolean("Email", "enabled", False, False)
@@ -103,6 +311,48 @@ class SuckleSync:
             self.mail["mode"] = self.configuration.GetText("Email", "smtp_mode", None)
             self.mail["username"] = self.configuration.GetText("Email", "smtp_username", None)
             self.mail["password"] = self.configuration.GetText("Email", "smtp_password", None)
+            self.mail["digest_count"] = max(1, self.configuration.GetInt("Email", "digest_count", 1, False))
+            self.mail["digest_interval"] = self.configuration.GetInt("Email", "digest_interval", 600, False)
+            self.mail["spool"] = self.configuration.GetText("Email", "spool", None, False)
+
+        # every sucklepath is pulled from [Remote] hostname unless hostN names
+        # a [Host NAME] section or another hostname
+        if self.paths:
+            self.paths["host"] = []
+            for key, name in enumerate(self.configuration.GetItemList("Sucklepaths", "host", len(self.paths["source"]), None)):
+                if name is None:
+                    name = self.remote["hostname"]
+                    if not name:
+                        self.debugger.critical("[Sucklepaths] 'host%d' not set and no [Remote] 'hostname' defined, exiting.", (key + 1,))
+                if name not in self.hosts:
+                    self.hosts[name] = self._load_host(name)
+                self.paths["host"].append(name)
+
+    # Settings of one remote host: those in its [Host NAME] section, if there
+    # is one, fall back to [Remote], [Local] and [Transfer]. Without a section,
+    # the name is the hostname.
+    def _load_host(self, name):
+        try:
+            from shlex import quote as cmd_quote
+        except ImportError:
+            from pipes import quote as cmd_quote
+
+        section = "Host " + name
+        host = {"name": name}
+        host["hostname"] = self.configuration.GetText(section, "hostname", name, False)
+        host["port"] = self.configuration.GetInt(section, "port", self.remote["port"], False)
+        host["username"] = self.configuration.GetText(section, "username", self.remote["username"], False)
+        host["ssh_flags"] = self.configuration.GetText(section, "ssh_flags", self.local["ssh_flags"], False)
+        host["find"] = self.remote["find"]
+        if self.configuration.parser.has_option(section, "find"):
+            host["find"] = cmd_quote(self.configuration.GetText(section, "find"))
+        host["agent"] = self.configuration.GetBoolean(section, "agent", self.remote["agent"], False)
+        host["agent_python"] = self.configuration.GetText(section, "agent_python", self.remote["agent_python"], False)
+
+        # at most this many scans and transfers run at once on this host
+        host["scans"] = max(1, self.configuration.GetInt(section, "scans", self.remote["scans"], False))
+        host["workers"] = max(1, self.configuration.GetInt(section, "workers", self.transfer["workers"], False))
+        return host
 
     # Determine if pid in pidfile is a running process.
     def is_running(self):
@@ -137,15 +387,34 @@ def start(ss):
     except IOError:
         ss.debugger.critical("failed to write to logfile: %s", (ss.logging["filename"],))
 
+    # test that we can write to the manifest
+    if ss.state["manifest"]:
+        try:
+            with open(ss.state["manifest"], "a"):
+                ss.debugger.info("successfully writing to manifest")
+        except IOError:
+            ss.debugger.critical("failed to write to manifest: %s", (ss.state["manifest"],))
+
+    # test that we can write the journal
+    if ss.state["journal"]:
+        try:
+            with open(ss.state["journal"] + ".tmp", "w"):
+                ss.debugger.info("successfully writing to journal")
+        except IOError:
+            ss.debugger.critical("failed to write to journal: %s", (ss.state["journal"],))
+
     # test rsync -- run a NOP, only success returns
     command = ss.local["rsync"] + " -qh"
-    _rsync(command)
+    for line in _rsync(command):
+        pass
     ss.debugger.info("successfully tested local rsync: %s", (command,))
 
-    # test ssh -- run a NOP find, only success returns
-    command = ss.local["ssh"] + " " + ss.remote["hostname"] + " " + ss.local["ssh_flags"] + " " + ss.remote["find"] + " " + ss.remote["find"] + " -type d"
-    _ssh(command, True)
-    ss.debugger.info("successfully tested ssh to remote server: %s", (command,))
+    # test ssh -- run a NOP find on every host, only success returns
+    for name, host in sorted(ss.hosts.iteritems()):
+        command = _ssh_command(host["find"] + " " + host["find"] + " -type d", host)
+        for line in _ssh(command, True):
+            pass
+        ss.debugger.info("successfully tested ssh to remote server %s: %s", (name, command))
 
     if ss.daemonize:
         try:
@@ -166,7 +435,12 @@ def start(ss):
 
         try:
             ss.debugger.logToFile()
-            daemon = daemonize.Daemonize(app="sucklesync", pid=ss.logging["pidfile"], action=sucklesync, keep_fds=[ss.debugger.handler.stream.fileno()], logger=ss.logger, verbose=True)
+            keep_fds = [ss.debugger.handler.stream.fileno()]
+            if ss.debugger.json:
+                keep_fds.append(ss.debugger.json.fileno())
+            # Queued records are written by a thread, which won't survive the fork.
+            ss.debugger.flush()
+            daemon = daemonize.Daemonize(app="sucklesync", pid=ss.logging["pidfile"], action=sucklesync, keep_fds=keep_fds, logger=ss.logger, verbose=True)
             daemon.start()
         except Exception as e:
             ss.debugger.critical("Failed to daemonize: %s, exiting", (e,))
@@ -196,6 +470,12 @@ def stop(ss, must_be_running = True):
             else:
                 ss.debugger.critical("Failed: %s", (e,))
 
+    # The daemon closes its master connections as it exits, make sure they
+    # aren't left behind if the daemon died without cleaning up.
+    sucklesync.sucklesync_instance = ss
+    for host in ss.hosts.itervalues():
+        _connection(host).stop()
+
 def restart(ss):
     import time
 
@@ -210,240 +490,1836 @@ def restart(ss):
         running = ss.is_running()
     start(ss)
 
+# Ask the running daemon to reload its configuration file.
+def reload(ss):
+    import os
+    import signal
+    import errno
+
+    pid = ss.is_running()
+    if not pid:
+        ss.debugger.critical("Sucklesync is not running.")
+
+    ss.debugger.warning("Reloading sucklesync configuration...")
+    try:
+        os.kill(pid, signal.SIGHUP)
+    except OSError as e:
+        if e.errno == errno.EPERM:
+            ss.debugger.critical("Failed (perhaps try with sudo): %s", (e,))
+        else:
+            ss.debugger.critical("Failed: %s", (e,))
+
 def status(ss):
     pid = ss.is_running()
     if pid:
         ss.debugger.warning("Sucklesync is running with pid %d", (pid,))
+        if ss.state["control"]:
+            _status_control(ss)
+        elif ss.monitoring["port"]:
+            _status_metrics(ss)
     else:
         ss.debugger.warning("Sucklesync is not running.")
 
-def _ssh(command, fail_on_error = False):
+# Summarize the metrics of the running daemon.
+def _status_metrics(ss):
+    import json
+    import urllib2
+
+    url = "http://%s:%d/metrics.json" % (ss.monitoring["address"], ss.monitoring["port"])
+    try:
+        current = json.load(urllib2.urlopen(url, timeout=5))
+    except Exception as e:
+        ss.debugger.error("failed to read metrics from %s: %s", (url, e))
+        return
+
+    received = {}
+    for value in current["sucklesync_received_bytes_total"]["values"]:
+        received[value["labels"]["sucklepath"]] = value["value"]
+    transfers = {}
+    for value in current["sucklesync_transfers_total"]["values"]:
+        transfers[value["labels"]["sucklepath"]] = transfers.get(value["labels"]["sucklepath"], 0) + value["value"]
+    for value in current["sucklesync_queue_depth"]["values"]:
+        sucklepath = value["labels"]["sucklepath"]
+        ss.debugger.warning(" %s: %d queued, %d transferred, %d bytes received", (sucklepath, value["value"], transfers.get(sucklepath, 0), received.get(sucklepath, 0)))
+    for value in current["sucklesync_errors_total"]["values"]:
+        ss.debugger.warning(" %s errors: %d", (value["labels"]["command"], value["value"]))
+
+# Summarize what the running daemon is doing, asking it through its control
+# socket.
+def _status_control(ss):
+    import socket
+
+    try:
+        current = control.request(ss.state["control"], {"command": "status"})
+    except (socket.error, ValueError) as e:
+        ss.debugger.error("failed to reach sucklesync on %s: %s", (ss.state["control"], e))
+        return
+    if _print_json(ss, current):
+        return
+
+    for sucklepath in current["sucklepaths"]:
+        if not sucklepath["synced"]:
+            state = "synced by another instance"
+        elif sucklepath["polling"]:
+            state = "polling (%s)" % sucklepath["polling"]
+        elif sucklepath["next_poll"] is None:
+            state = "polling"
+        else:
+            state = "next poll in %d seconds" % sucklepath["next_poll"]
+        ss.debugger.warning(" %d %s:%s: %d queued, %d transferring, %s", (sucklepath["sucklepath"], sucklepath["host"], sucklepath["source"], sucklepath["queued"], sucklepath["transferring"], state))
+
+# Send a request to the running daemon's control socket, exiting if it can't
+# be reached or the request fails.
+def _control(ss, message):
+    import socket
+
+    if not ss.state["control"]:
+        ss.debugger.critical("no control socket configured, set [State] control")
+    try:
+        response = control.request(ss.state["control"], message)
+    except (socket.error, ValueError) as e:
+        ss.debugger.critical("failed to reach sucklesync on %s: %s", (ss.state["control"], e))
+    if "error" in response:
+        ss.debugger.critical("%s", (response["error"],))
+    return response
+
+# With --json, print a control response as is. Returns True if it was
+# printed.
+def _print_json(ss, response):
+    import json
+
+    if not getattr(ss.args, "json", False):
+        return False
+    print json.dumps(response, indent=2, sort_keys=True)
+    return True
+
+# List the directories queued by the running daemon, in the order they'll be
+# transferred.
+def queue(ss):
+    current = _control(ss, {"command": "queue"})
+    if _print_json(ss, current):
+        return
+    if not current["queue"]:
+        ss.debugger.warning("Nothing is queued.")
+    for position, item in enumerate(current["queue"]):
+        ss.debugger.warning(" %d. %s from %d %s: %d bytes, %d files", (position + 1, item["directory"], item["sucklepath"], item["source"], item["size"], item["files"]))
+
+# List the transfers the running daemon has in progress.
+def transfers(ss):
+    current = _control(ss, {"command": "transfers"})
+    if _print_json(ss, current):
+        return
+    if not current["transfers"]:
+        ss.debugger.warning("Nothing is being transferred.")
+    for transfer in current["transfers"]:
+        if transfer["percent"] is None:
+            progress = "starting"
+        else:
+            progress = "%s%% (%d bytes), %s, %s remaining" % (transfer["percent"], transfer["bytes"], transfer["rate"], transfer["eta"])
+        ss.debugger.warning(" %s from %d %s: %s, running %d seconds", (transfer["directory"], transfer["sucklepath"], transfer["source"], progress, transfer["elapsed"] or 0))
+
+# Ask the running daemon to poll a sucklepath right away.
+def poll(ss):
+    current = _control(ss, {"command": "poll", "sucklepath": ss.args.sucklepath})
+    if current.get("deferred"):
+        ss.debugger.warning("%s is being polled, polling it again once that poll is over.", (current["source"],))
+    else:
+        ss.debugger.warning("Polling %s.", (current["source"],))
+
+# Ask the running daemon to transfer a queued directory next.
+def prioritize(ss):
+    current = _control(ss, {"command": "prioritize", "sucklepath": ss.args.sucklepath, "directory": ss.args.directory})
+    ss.debugger.warning("Moved %s of %s to the front of the queue.", (current["directory"], current["source"]))
+
+# The settings of the host a sucklepath is pulled from.
+def _host(key):
+    ss = sucklesync.sucklesync_instance
+    return ss.hosts[ss.paths["host"][key]]
+
+# Wrap a command so it runs on a remote host.
+def _ssh_command(remote_command, host):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+
+    ss = sucklesync.sucklesync_instance
+    return ss.local["ssh"] + " " + host["hostname"] + " " + host["ssh_flags"] + _connection(host).options() + " " + cmd_quote(remote_command)
+
+# The ssh command rsync should use to reach a remote host: the same ssh, flags
+# and options as every other command run on it, so rsync still authenticates
+# when the master connection is down or disabled.
+def _rsync_transport(host):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+
+    ss = sucklesync.sucklesync_instance
+    command = ss.local["ssh"]
+    if host["ssh_flags"]:
+        command += " " + host["ssh_flags"]
+    return " -e " + cmd_quote(command + _connection(host).options())
+
+# The (lazily created) master connection to a remote host.
+def _connection(host):
+    ss = sucklesync.sucklesync_instance
+    if host["name"] not in ss.connections:
+        ss.connections[host["name"]] = connection.Connection(ss, host["hostname"], host["port"], host["username"], host["ssh_flags"])
+    return ss.connections[host["name"]]
+
+# Run a command over ssh, yielding its output one line at a time. If a status
+# dict is passed in, the return code is stored in it once the command exits.
+# The command is killed if it produces no output for timeout seconds (by
+# default ssh_timeout, 0 for never), or runs for longer than limit seconds.
+def _ssh(command, fail_on_error = False, status = None, limit = None, timeout = None):
+    import time
+
     ss = sucklesync.sucklesync_instance
     ss.debugger.debug("_ssh: %s", (command,))
 
+    if timeout is None:
+        timeout = ss.remote["ssh_timeout"]
     try:
-        output = EasyProcess(command).call(timeout=ss.remote["ssh_timeout"])
-        if output.timeout_happened:
-            ss.debugger.error("failed to ssh to remote server, took longer than %d seconds. Failed command: %s", (ss.remote["timeout"], command))
-        elif output.return_code:
-            ss.debugger.error("ssh to remote server returned error code (%d), error (%s). Failed command: %s", (output.return_code, output.stderr, command))
+        started = time.time()
+        output = process.Stream(command, timeout, limit)
+        for line in output:
+            yield line
+        ss.stats["ssh_duration"].observe(time.time() - started)
+
+        failed = True
+        if output.cancelled:
+            ss.debugger.warning("cancelled command: %s", (command,))
+        elif output.timeout_happened:
+            ss.debugger.error("failed to ssh to remote server, no response for %d seconds. Failed command: %s", (timeout, command))
+        elif output.limit_happened:
+            ss.debugger.error("remote command took longer than %d seconds. Failed command: %s", (limit, command))
         elif output.oserror:
             ss.debugger.error("failed to ssh to remote server, error (%s). Failed command: %s", (output.oserror, command))
+        elif output.return_code:
+            ss.debugger.error("ssh to remote server returned error code (%d), error (%s). Failed command: %s", (output.return_code, output.stderr, command))
+        else:
+            failed = False
 
-        return output.stdout.splitlines()
+        if failed:
+            ss.stats["errors"].inc(command="ssh")
+        if status is not None:
+            status["return_code"] = output.return_code
+        if failed and fail_on_error:
+            ss.debugger.critical("failed to ssh to remote server, exiting")
 
     except Exception as e:
         ss.debugger.error("_ssh exception, failed command: %s", (command,))
         ss.debugger.dump_exception("_ssh() exception")
 
-def _rsync(command):
+# The remote agent on a host, (re)started as needed, or None if it isn't
+# enabled or couldn't be started.
+def _agent(host):
+    ss = sucklesync.sucklesync_instance
+    remote = ss.agents.get(host["name"])
+    if not remote:
+        return None
+
+    # Scans run concurrently, only one of them starts the agent.
+    with remote.starting:
+        if not host["agent"]:
+            return None
+        if remote.alive():
+            return remote
+        try:
+            remote.start()
+            ss.debugger.info("started remote agent on %s (python %s)", (host["name"], remote.python))
+            return remote
+        except agent.AgentError as e:
+            ss.stats["errors"].inc(command="agent")
+            if remote.python is None:
+                # It has never worked, there's probably no usable python there.
+                ss.debugger.error("failed to start remote agent on %s, scanning with find instead: %s", (host["name"], e))
+                host["agent"] = False
+            else:
+                ss.debugger.error("failed to restart remote agent on %s: %s", (host["name"], e))
+            return None
+
+# Scan the source with the remote agent, which only sends back the summaries
+# of top-level directories that changed since its previous scan. Returns
+# False if the agent isn't available, so the caller can fall back to find.
+def _scan_agent(host, source, directories):
+    ss = sucklesync.sucklesync_instance
+
+    remote = _agent(host)
+    if not remote:
+        return False
+    try:
+        result = remote.summaries(source, directories, ss.remote["scan_timeout"], ss.remote["marker"], ss.remote["lock"])
+        if result is None:
+            ss.stats["errors"].inc(command="agent")
+            ss.debugger.error("remote agent didn't scan %s within %d seconds", (source, ss.remote["scan_timeout"]))
+        return result
+    except agent.AgentError as e:
+        ss.stats["errors"].inc(command="agent")
+        ss.debugger.error("remote agent failed to scan %s, scanning with find instead: %s", (source, e))
+        return False
+
+# Walk the source on a remote host once, summarizing each top-level directory
+# as the output arrives. If a list of directories is passed in, only they are
+# walked. Returns None if the remote host could not be scanned.
+def _scan(host, source, directories = None):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    started = time.time()
+    result = _scan_agent(host, source, directories)
+    if result is not False:
+        return _scan_finished(source, directories, result, started)
+
+    result = scan.Scan(source, directories, ss.remote["marker"], ss.remote["lock"])
+    command = scan.CLOCK_COMMAND + host["find"] + " " + cmd_quote(source)
+    if directories is not None:
+        # Prune every top-level entry that wasn't asked for.
+        command += " -mindepth 1 '(' -path " + cmd_quote(_find_escape(source.rstrip("/")) + "/*/*")
+        for directory in directories:
+            command += " -o -name " + cmd_quote(_find_escape(directory))
+        command += " ')' -printf " + cmd_quote(scan.PRINTF_FORMAT) + " -o -prune"
+    else:
+        command += " -printf " + cmd_quote(scan.PRINTF_FORMAT)
+
+    status = {}
+    for line in _ssh(_ssh_command(command, host), False, status, ss.remote["scan_timeout"]):
+        result.add(line)
+    result.complete = status.get("return_code") == 0
+    return _scan_finished(source, directories, result, started)
+
+# Record a finished scan, returning the result or None if it failed.
+def _scan_finished(source, directories, result, started):
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    if result is None:
+        return None
+    elapsed = time.time() - started
+    ss.stats["scan_duration"].observe(elapsed, sucklepath=source)
+    ss.stats["scan_received"].inc(result.received, sucklepath=source)
+    ss.debugger.debug("scanned %s: %d entries in %.2f seconds, %d bytes received", (source, result.entries, elapsed, result.received), sucklepath=source, duration=elapsed, entries=result.entries, bytes=result.received, complete=result.complete)
+
+    if not result.entries and not (directories is not None and result.complete):
+        return None
+    return result
+
+# Escape the characters find treats as wildcards in -name and -path patterns.
+def _find_escape(pattern):
+    return FIND_WILDCARDS.sub(r"\\\g<0>", pattern)
+
+# Run rsync, yielding its output one line at a time as it's produced. Progress
+# lines (--info=progress2) are not yielded; if a status dict is passed in, they
+# update it instead, along with the return code once rsync exits. The running
+# process.Stream is kept in it too, so rsync can be cancelled.
+def _rsync(command, status = None):
     ss = sucklesync.sucklesync_instance
     ss.debugger.debug("_rsync: %s", (command,))
 
     try:
-        output = EasyProcess(command).call()
-        if output.return_code:
-            ss.debugger.error("rsync returned error code (%d), error (%s). Failed command: %s", (output.return_code, output.stderr, command))
+        output = process.Stream(command)
+        if status is not None:
+            status["stream"] = output
+        for line in output:
+            progress = RSYNC_PROGRESS.match(line)
+            if progress:
+                if status is not None:
+                    transferred, percent, rate, eta = progress.groups()
+                    if percent != status.get("percent"):
+                        ss.debugger.debug2(" %s: %s%% %s (%s remaining)", (status.get("directory"), percent, rate, eta))
+                    status.update({"bytes": int(transferred.replace(",", "")), "percent": percent, "rate": rate, "eta": eta})
+                continue
+            yield line
+
+        if output.cancelled:
+            ss.debugger.warning("cancelled command: %s", (command,))
         elif output.oserror:
             ss.debugger.error("rsync failed, error (%s). Failed command: %s", (output.oserror, command))
-
-        return output.stdout.splitlines()
+            ss.stats["errors"].inc(command="rsync")
+        elif output.return_code:
+            ss.debugger.error("rsync returned error code (%d), error (%s). Failed command: %s", (output.return_code, output.stderr, command))
+            ss.stats["errors"].inc(command="rsync")
+        if status is not None:
+            status["return_code"] = output.return_code
 
     except Exception as e:
         ss.debugger.error("_rsync exception, failed command: %s", (command,))
         ss.debugger.dump_exception("_rsync() exception")
 
-def _cleanup(source, key):
-    import re
+# Delete local files that were deleted on the source. Top-level entries missing
+# from a complete scan are removed directly; a full rsync --delete pass, which
+# also finds files deleted deeper in the tree, runs every [Local]
+# delete_interval seconds (or whenever no complete scan is available).
+def _cleanup(source, key, result = None):
+    import time
 
     ss = sucklesync.sucklesync_instance
     ss.debugger.debug("_cleanup: %s (%d)", (source, key))
 
     try:
-        deleted = []
-        if ss.local["delete"]:
-            # Delete files/directories that were deleted on the source.
-            cleanup = ss.local["rsync"] + " --recursive --delete --ignore-existing --existing --prune-empty-dirs --verbose"
-            cleanup += " " + ss.remote["hostname"] + ':"' + source + '/"'
-            cleanup += " " + ss.paths["destination"][key]
-            output = _rsync(cleanup)
-
-            prefix = True
-            for line in output:
-                if prefix:
-                    if re.search("receiving file list", line):
-                        prefix = False
-                    else:
-                        ss.debugger.debug("PREFIX: %s", (line,))
-                else:
-                    try:
-                        if re.search("sent (.*) bytes", line):
-                            # All done with the information we care about.
-                            break
-                        ss.debugger.debug(" %s ...", (line,))
-                        deleted.append(line)
-                    except:
-                        # This shouldn't happen during file deletion.
-                        continue
-        else:
+        if not ss.local["delete"]:
             ss.debugger.debug("local delete disabled")
+            return 0
+
+        now = time.time()
+        if result and result.complete and now - ss.cleaned.get(key, 0) < ss.local["delete_interval"]:
+            return _cleanup_removed(source, key, result)
 
+        deleted = _cleanup_full(source, key)
+        if deleted is not None:
+            ss.cleaned[key] = now
+            ss.debugger.debug("cleaned up %d deleted files in %s in %.2f seconds", (deleted, ss.paths["destination"][key], time.time() - now), sucklepath=source, deleted=deleted, duration=time.time() - now)
         return deleted
 
     except Exception as e:
         ss.debugger.dump_exception("_cleanup() exception")
 
-def sucklesync():
-    from utils import simple_timer
-    import re
+# Delete top-level entries of the destination that are no longer on the source.
+# Stops if the sucklepath's lease is lost meanwhile.
+def _cleanup_removed(source, key, result):
+    import os
+    import shutil
+
+    ss = sucklesync.sucklesync_instance
+    destination = ss.paths["destination"][key]
+
+    # A partial scan can only say which of the directories it walked are gone.
+    if result.directories is None:
+        names = os.listdir(destination)
+    else:
+        names = [name for name in result.directories if os.path.lexists(os.path.join(destination, name))]
+
+    deleted = 0
+    for name in names:
+        # Hidden entries are not scanned (and include rsync's temporary files).
+        if name[0] == "." or name in result.summaries:
+            continue
+
+        if not _owned(key):
+            # Its lease was lost, whoever took over cleans up from now on.
+            break
+        path = os.path.join(destination, name)
+        ss.debugger.info(" deleting %s ...", (path,))
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        if ss.manifest:
+            ss.manifest.forget(source, destination, name)
+        deleted += 1
+    return deleted
+
+# Delete files anywhere in the destination that are no longer on the source.
+# Returns None if rsync failed, or was stopped as the sucklepath's lease was
+# lost meanwhile.
+def _cleanup_full(source, key):
+    ss = sucklesync.sucklesync_instance
+
+    host = _host(key)
+    cleanup = ss.local["rsync"] + " --recursive --delete --ignore-existing --existing --prune-empty-dirs --verbose" + _rsync_transport(host)
+    if ss.transfer["partial"]:
+        # Keep what interrupted transfers have received so far.
+        cleanup += " --filter='P " + PARTIAL_DIR + "/'"
+    cleanup += " " + host["hostname"] + ':"' + source + '/"'
+    cleanup += " " + ss.paths["destination"][key]
+
+    status = {}
+    deleted = 0
+    prefix = True
+    suffix = False
+    for line in _rsync(cleanup, status):
+        if not _owned(key):
+            # Whoever took over cleans up from now on; leaving the loop
+            # kills rsync.
+            return None
+        if prefix:
+            if RSYNC_FILE_LIST.search(line):
+                prefix = False
+            else:
+                ss.debugger.debug("PREFIX: %s", (line,))
+        elif suffix:
+            # All done with the information we care about.
+            continue
+        elif RSYNC_SENT.search(line):
+            suffix = True
+        else:
+            ss.debugger.debug(" %s ...", (line,))
+            deleted += 1
+
+    if status.get("return_code") != 0:
+        return None
+    return deleted
+
+# Rsync directories of one sucklepath from the source with a single rsync,
+# returning what was synchronized for each. A batch of more than one directory
+# is passed to rsync with --files-from, and the files it lists are attributed
+# to directories by their first path component; the stats of the transfer are
+# included in every result. While the transfer runs, its progress can be found
+# in ss.progress.
+def _transfer_batch(host, source, destination, directories, limit = 0, dedup = False):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+    import os
+    import tempfile
     import time
 
     ss = sucklesync.sucklesync_instance
+    results = [{"source": source, "destination": destination, "directory": directory, "transferred": False, "synced": [], "stats": []} for directory in directories]
+    by_directory = dict((result["directory"], result) for result in results)
+    targets = [os.path.join(destination, directory) for directory in directories]
+    status = {"source": source, "directory": directories[0] if len(directories) == 1 else "%d directories" % len(directories), "started": time.time()}
+    for target in targets:
+        ss.progress[target] = status
+
+    files = None
+    inside = False
+    received_bytes = 0
+    try:
+        sync = ss.local["rsync"] + " " + ss.local["rsync_flags"] + _rsync_transport(host)
+        if ss.transfer["progress"]:
+            sync += " --info=progress2"
+        if ss.transfer["partial"]:
+            # Interrupted transfers resume from what was already received.
+            sync += " --partial-dir=" + PARTIAL_DIR
+        if limit:
+            sync += " --bwlimit=%d" % limit
+        target = destination
+        if len(directories) == 1:
+            remote = source + "/" + re.escape(directories[0])
+            candidates = _dedup_candidates(host, source, destination, directories[0]) if dedup else None
+            if candidates:
+                # The directory's contents are transferred into it, so rsync
+                # looks for each file at the same path under the candidates.
+                inside = True
+                for candidate in candidates:
+                    sync += " --%s-dest=%s" % (ss.dedup["mode"], cmd_quote(candidate))
+                remote += "/"
+                target = cmd_quote(targets[0])
+                ss.debugger.debug(" deduplicating %s against %s", (directories[0], ", ".join(candidates)))
+            sync += " " + host["hostname"] + ':"' + remote + '"'
+        else:
+            files = tempfile.NamedTemporaryFile(prefix="sucklesync-", suffix=".files")
+            files.write("".join(directory + "\n" for directory in directories))
+            files.flush()
+            # --files-from turns off the recursion implied by -a
+            sync += " --recursive --files-from=" + cmd_quote(files.name)
+            sync += " " + host["hostname"] + ':"' + source + '/"'
+        sync += " " + target
+
+        prefix = True
+        suffix = False
+        for line in _rsync(sync, status):
+            if prefix:
+                if RSYNC_FILE_LIST.search(line):
+                    prefix = False
+            elif suffix:
+                for result in results:
+                    result["stats"].append(line)
+                ss.debugger.debug("stats: %s", (line,))
+            elif RSYNC_SENT.search(line):
+                suffix = True
+                for result in results:
+                    result["stats"].append(line)
+                received = RSYNC_RECEIVED.search(line)
+                if received:
+                    received_bytes = _size(*received.groups())
+                    ss.stats["received"].inc(received_bytes, sucklepath=source)
+            else:
+                directory_synced = directories[0] if inside else line.split("/")[0]
+                result = by_directory.get(directory_synced)
+                if result and not result["synced"]:
+                    result["transferred"] = True
+                    ss.debugger.debug(" synced %s ...", (directory_synced,))
+                    result["synced"].append(directory_synced)
 
-    run = True
-    timer = None
+    except Exception as e:
+        ss.debugger.dump_exception("_transfer_batch() exception")
+
+    finally:
+        if files:
+            files.close()
+        for target in targets:
+            del ss.progress[target]
+
+    if ss.fingerprints and status.get("return_code") == 0:
+        _index(targets)
+
+    elapsed = time.time() - status["started"]
+    ss.stats["transfer_duration"].observe(elapsed, sucklepath=source)
+    for result in results:
+        result["return_code"] = status.get("return_code")
+        result["restart"] = status.get("restart", False)
+        ss.profiler.transfer(source, result["directory"], elapsed, result["return_code"])
+        ss.stats["transfers"].inc(sucklepath=source, result="ok" if result["return_code"] == 0 else "failed")
+        ss.debugger.info(" transferred %s in %.2f seconds", (result["directory"], elapsed), sucklepath=source, directory=result["directory"], duration=elapsed, bytes=received_bytes, batch=len(results), return_code=result["return_code"])
+    return results
+
+# Local directories already holding files of a remote directory that is about
+# to be transferred, those holding the most bytes first. The remote files are
+# listed and looked up in the fingerprint index: a local file with the same
+# size and modification time (and hash, if enabled) at the same relative path
+# makes the directory it's under a candidate for --link-dest or --copy-dest.
+def _dedup_candidates(host, source, destination, directory):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+    import os
 
-    sleep_delay = 0
+    ss = sucklesync.sucklesync_instance
+
+    remote = cmd_quote(os.path.join(source, directory))
+    command = host["find"] + " " + remote + " -type f -printf '%s %T@ %P\\n'"
+    if ss.dedup["hash"]:
+        # Costs reading the files on the remote server, but nothing over the
+        # network, and rules out files that only look the same.
+        command += " && cd " + remote + " && " + host["find"] + " . -type f -exec sha1sum {} +"
+
+    files = {}
+    digests = {}
+    status = {}
+    # sha1sum prints nothing until it has read a whole file, which can take a
+    # while for large files: only the overall scan_timeout applies.
+    timeout = 0 if ss.dedup["hash"] else None
+    for line in _ssh(_ssh_command(command, host), False, status, ss.remote["scan_timeout"], timeout):
+        match = SHA1SUM_LINE.match(line)
+        if match:
+            digests[match.group(2)] = match.group(1)
+            continue
+        try:
+            size, mtime, path = line.split(" ", 2)
+            files[path] = (int(size), float(mtime))
+        except ValueError:
+            continue
+    if ss.dedup["hash"] and status.get("return_code") != 0:
+        # Without hashes, every candidate would be rejected.
+        ss.debugger.warning("skipping deduplication of %s, failed to hash the remote files", (os.path.join(source, directory),))
+        return []
+
+    target = os.path.join(destination, directory)
+    found = collections.Counter()
+    rejected = set()
+    for path, (size, mtime) in files.iteritems():
+        if not size:
+            continue
+        for local, digest in ss.fingerprints.lookup(size, mtime):
+            if not local.endswith("/" + path):
+                continue
+            candidate = local[:-len(path) - 1]
+            if candidate == target:
+                continue
+            if ss.dedup["hash"] and digest != digests.get(path):
+                # rsync would link it, trusting size and modification time.
+                rejected.add(candidate)
+                continue
+            found[candidate] += size
+    return [candidate for candidate, size in found.most_common() if candidate not in rejected and os.path.isdir(candidate)][:ss.dedup["candidates"]]
+
+# Add the files under local directories to the fingerprint index.
+def _index(directories):
+    import os
+
+    ss = sucklesync.sucklesync_instance
+
+    for directory in directories:
+        try:
+            if os.path.isdir(directory):
+                ss.fingerprints.add_tree(directory, (PARTIAL_DIR,))
+        except Exception as e:
+            ss.debugger.dump_exception("_index() exception")
+
+# Index what is already under the destinations, in the background at start.
+def _index_destinations():
+    import os
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    started = time.time()
+    directories = []
+    for destination in sorted(set(ss.paths["destination"])):
+        try:
+            directories += [os.path.join(destination, name) for name in sorted(os.listdir(destination))]
+        except OSError as e:
+            ss.debugger.warning("failed to index %s: %s", (destination, e))
+    _index(directories)
+    ss.debugger.info("indexed %d directories for deduplication in %.2f seconds", (len(directories), time.time() - started))
+
+# Convert a size reported by rsync (possibly human readable, with -h) to bytes.
+def _size(number, unit = ""):
+    return int(float(number.replace(",", "")) * 1000 ** " KMGTP".index(unit or " "))
+
+# Email a notification about a transfer, listing up to three upcoming downloads.
+def _notify(result, upcoming):
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.mail["enabled"]:
+        return
+
+    mail_text = "Successfully synchronized:\n"
+    mail_html = "<p>Successfully synchronized:</p><ul>"
+    for directory_synced in result["synced"]:
+        mail_text += " - " + directory_synced + "\n"
+        mail_html += "<li>" + directory_synced
+    for key, line in enumerate(result["stats"]):
+        if key:
+            mail_text += line
+            mail_html += "<br />" + line
+        else:
+            mail_text += "\n" + line
+            mail_html += "</ul><p>" + line
+    mail_html += "</p>"
+
+    # Only the most recent list of upcoming downloads is worth including in
+    # a digest.
+    trailer = None
+    if upcoming:
+        trailer_text = "Next download:\n - " + upcoming[0] + "\n"
+        trailer_html = "<p>Next download:<ul><li>" + upcoming[0] + "</li>"
+        ss.debugger.debug(" next up %s ... [%d remaining]", (upcoming[0], len(upcoming)))
+        for directory in upcoming[1:3]:
+            trailer_text += " - " + directory + "\n"
+            trailer_html += "<li>" + directory + "</li>"
+        trailer_html += "</ul></p>"
+        trailer = (trailer_text, trailer_html)
+
+    ss.mail["email"].Notify("[sucklesync] file copied", mail_text, mail_html, trailer)
+
+# Returns True if the directory hasn't changed since it was last synced, and
+# is still there locally.
+def _unchanged(source, key, directory, summary):
+    import os
+
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.manifest:
+        return False
+    if not ss.manifest.unchanged(source, ss.paths["destination"][key], directory, summary.signature()):
+        return False
+    return os.path.lexists(os.path.join(ss.paths["destination"][key], directory))
+
+# In watch mode, returns the directories of a sucklepath that have changed and
+# since gone quiet, or None when the whole source needs to be walked: on the
+# first poll, whenever the watcher had to be restarted (and so may have missed
+# changes), and every [Frequency] sweep_delay seconds for consistency.
+def _watched(key):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+    import time
+
+    ss = sucklesync.sucklesync_instance
+    source = ss.paths["source"][key]
+
+    watcher = ss.watchers.get(key)
+    if not watcher or not watcher.alive():
+        if watcher:
+            ss.debugger.warning("watcher for %s exited, restarting", (source,))
+        command = _ssh_command(ss.remote["watch_command"] + " " + cmd_quote(source), _host(key))
+        ss.debugger.debug("_watched: %s", (command,))
+        watcher = ss.watchers[key] = watch.Watcher(source, command)
+        watcher.start()
+        ss.swept[key] = 0
+
+    # Waiting for directories to be stable takes scanning them as they change.
+    now = time.time()
+    directories = watcher.quiet(now, 0 if ss.remote["readiness"] == "stable" else ss.remote["active_window"])
+    if now - ss.swept.get(key, 0) >= ss.frequency["sweep_delay"]:
+        ss.swept[key] = now
+        return None
+    return set(directories)
+
+# Queue a directory for transfer, or re-prioritize it if it's already queued.
+def _queue(key, directory, summary):
+    ss = sucklesync.sucklesync_instance
+    if not _owned(key):
+        # Scanned just before its lease was lost or handed over.
+        return
+    ss.queue.push((key, directory), summary, ss.paths["weight"][key])
+
+# Split the directories of a sucklepath's latest scan into those that are
+# ready to be transferred and those still changing, as (ready, active). A
+# directory is ready once nothing in it has been modified for active_window
+# seconds or, with "stable" readiness, once its summary has been the same for
+# stable_scans scans in a row. The marker and lock files override both.
+def _readiness(key, result, now):
+    ss = sucklesync.sucklesync_instance
+
+    observed = ss.stability.setdefault(key, {})
+    for directory in observed.keys():
+        if directory not in result.summaries and (result.directories is None or directory in result.directories):
+            del observed[directory]
+
+    ready = []
+    active = []
+    for directory, summary in result.summaries.iteritems():
+        quiet = summary.mtime <= now - ss.remote["active_window"]
+        if ss.remote["readiness"] == "stable":
+            seen = observed.get(directory)
+            if seen and seen[0] == summary.signature():
+                seen[1] += 1
+            else:
+                seen = observed[directory] = [summary.signature(), 1]
+            quiet = quiet or seen[1] >= ss.remote["stable_scans"]
+        if summary.locked:
+            quiet = False
+        elif summary.marker:
+            quiet = True
+        if quiet:
+            ready.append(directory)
+        else:
+            active.append(directory)
+    return ready, active
+
+# Update the transfer queue from a sucklepath's latest scan: queue directories
+# that are ready, and drop those that are changing again or have disappeared.
+# Returns the directories that are still changing.
+def _classify(key, result):
+    import time
+
+    ss = sucklesync.sucklesync_instance
+    source = ss.paths["source"][key]
+
+    # Modification times are compared against the remote server's clock, when
+    # the scan reported it.
+    now = result.now if result.now is not None else time.time()
+    ready, active = _readiness(key, result, now)
+    for directory in active:
+        ss.debugger.info(" excluding from queue %s ...", (directory,))
+        ss.queue.discard((key, directory))
+    for directory in ready:
+        if _unchanged(source, key, directory, result.summaries[directory]):
+            ss.debugger.debug(" unchanged since last sync %s ...", (directory,))
+            ss.queue.discard((key, directory))
+            continue
+        ss.debugger.info(" queueing %s ...", (directory,))
+        _queue(key, directory, result.summaries[directory])
+    for item in ss.queue:
+        if item[0] != key or item[1] in result.summaries:
+            continue
+        if result.directories is None or item[1] in result.directories:
+            ss.queue.discard(item)
+    return active
+
+# Publish how many directories each sucklepath has waiting.
+def _queue_depth():
+    ss = sucklesync.sucklesync_instance
+
+    depth = [0] * len(ss.paths["source"])
+    for key, directory in ss.queue:
+        depth[key] += 1
+    for key, source in enumerate(ss.paths["source"]):
+        ss.stats["queue_depth"].set(depth[key], sucklepath=source)
+
+# Write the metrics to [Metrics] json, if configured.
+def _dump_metrics():
+    import os
+
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.monitoring["json"]:
+        return
+    try:
+        with open(ss.monitoring["json"] + ".tmp", "w") as f:
+            f.write(ss.metrics.json())
+        os.rename(ss.monitoring["json"] + ".tmp", ss.monitoring["json"])
+    except (IOError, OSError) as e:
+        ss.debugger.error("failed to write metrics to %s: %s", (ss.monitoring["json"], e))
+
+# Start as many queued transfers as there are idle workers, never writing to
+# the same destination directory twice at once. in_flight maps the target of
+# every running transfer to the item and summary it was queued with.
+def _dispatch(in_flight):
+    import os
+
+    ss = sucklesync.sucklesync_instance
+
+    # Items of a host already running its share of transfers, or for a
+    # directory that is being written to, wait in place.
+    def ready(item):
+        key, directory = item
+        host = _host(key)
+        return ss.transferring[host["name"]] < host["workers"] and os.path.join(ss.paths["destination"][key], directory) not in in_flight
+
+    while ss.pool.available() and len(ss.queue):
+        # Wait for running transfers to hand back bandwidth if what is left
+        # would make for too small a share.
+        share = ss.budget.share(min(ss.pool.workers, ss.pool.running + len(ss.queue)))
+        if share is None:
+            break
+
+        queued = ss.queue.pop(ready)
+        if not queued:
+            break
+        (key, directory), summary = queued
+        host = _host(key)
+        target = os.path.join(ss.paths["destination"][key], directory)
+        batch = [(directory, summary)]
+        if _batchable(directory, summary):
+            batch += _batch(key, summary.size, in_flight)
+        targets = tuple(os.path.join(ss.paths["destination"][key], directory) for directory, summary in batch)
+        for target, (directory, summary) in zip(targets, batch):
+            in_flight[target] = ((key, directory), summary)
+        if len(batch) > 1:
+            ss.debugger.debug(" batching %d directories of %s", (len(batch), ss.paths["source"][key]))
+        if share:
+            ss.debugger.debug(" limiting %s to %d KB/s", (target, share))
+        # Only large directories are worth listing to look for duplicates.
+        dedup = ss.fingerprints is not None and len(batch) == 1 and batch[0][1].size >= ss.dedup["minimum_size"]
+        ss.budget.acquire(targets, share)
+        ss.transferring[host["name"]] += 1
+        ss.pool.submit(("transfer", (host["name"], targets)), _transfer_batch, host, ss.paths["source"][key], ss.paths["destination"][key], [directory for directory, summary in batch], share, dedup)
+    _queue_depth()
+
+# Once the bandwidth schedule changes the limit, restart the running transfers
+# whose share no longer suits it: they're put back in the queue, and resume
+# from what they had already received with a new share. Without a managed
+# --partial-dir, that would be thrown away, so they're left running with their
+# share.
+def _reshare_transfers():
+    ss = sucklesync.sucklesync_instance
+
+    outdated = ss.budget.outdated()
+    if not ss.transfer["partial"]:
+        return
+    for targets in outdated:
+        status = ss.progress.get(targets[0])
+        if not status or "stream" not in status:
+            # Not running rsync yet, or already done.
+            continue
+        ss.debugger.info(" restarting transfer of %s with a new bandwidth share", (status["directory"],))
+        status["restart"] = True
+        status["stream"].cancel()
+
+# Returns True if a directory is small enough to be transferred along with
+# others (and its name can be listed for --files-from).
+def _batchable(directory, summary):
+    ss = sucklesync.sucklesync_instance
+
+    return summary.size <= ss.transfer["batch_size"] and "\n" not in directory
+
+# Take more small directories of a sucklepath from the queue, in priority
+# order, to be transferred along with one of size bytes. Returns a list of
+# (directory, summary).
+def _batch(key, size, in_flight):
+    import os
+
+    ss = sucklesync.sucklesync_instance
+
+    batch = []
+    for item, summary in ss.queue.queued():
+        if len(batch) + 1 >= ss.transfer["batch_count"]:
+            break
+        queued_key, directory = item
+        if queued_key != key or not _batchable(directory, summary) or size + summary.size > ss.transfer["batch_bytes"]:
+            continue
+        if os.path.join(ss.paths["destination"][key], directory) in in_flight:
+            continue
+        ss.queue.discard(item)
+        batch.append((directory, summary))
+        size += summary.size
+    return batch
+
+# Record finished transfers.
+def _transferred(in_flight, targets, results):
+    import os
+    import sqlite3
+
+    ss = sucklesync.sucklesync_instance
+
+    items = [in_flight.pop(target) for target in targets]
+    ss.budget.release(targets)
+    if not results:
+        return
+
+    for result, ((key, directory), summary) in zip(results, items):
+        if result["restart"]:
+            # Stopped to be given a new bandwidth share.
+            if key is not None:
+                _queue(key, directory, summary)
+            continue
+        if result["return_code"] == 0 and ss.manifest:
+            try:
+                ss.manifest.set(result["source"], result["destination"], result["directory"], summary.signature())
+            except sqlite3.Error as e:
+                # It's compared again on the next poll.
+                ss.debugger.error("failed to record %s in manifest: %s", (os.path.join(result["destination"], result["directory"]), e))
+
+        if result["transferred"]:
+            with ss.profiler.phase("email"):
+                _notify(result, [directory for key, directory in ss.queue.upcoming(3)])
+
+# Scan a sucklepath, in one of the scanning threads.
+def _scan_job(key, directories):
+    ss = sucklesync.sucklesync_instance
+
+    host = _host(key)
+    with ss.profiler.phase("scan"):
+        # Reuse one connection for everything done on the host.
+        _connection(host).ensure()
+        return _scan(host, ss.paths["source"][key], directories)
+
+# Handle a finished scan, queueing the directories that are ready. Returns
+# True if the sucklepath has directories queued or still changing.
+def _scanned(key, directories, result):
+    ss = sucklesync.sucklesync_instance
+
+    if not _owned(key):
+        # Its lease was lost while it was being scanned.
+        return False
+
+    if not result:
+        # We may be having connectivity issues, try again later.
+        ss.debugger.warning("failed to scan %s, will try again later", (ss.paths["source"][key],))
+        if directories and key in ss.watchers:
+            for directory in directories:
+                ss.watchers[key].touch(directory)
+        return False
+
+    with ss.profiler.phase("classify"):
+        changing = _classify(key, result)
+    queued = any(item[0] == key for item in ss.queue)
+
+    if ss.remote["watch"]:
+        # Changes still in progress need to be checked on again.
+        for directory in changing:
+            ss.watchers[key].touch(directory)
+    return queued or bool(changing)
+
+# Write the queue and the transfers in progress to the journal, if configured.
+# Unless forced, this happens at most every [State] journal_interval seconds.
+def _save_journal(force = False):
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.journal:
+        return
+
+    # Transfers still running for sucklepaths removed by a reload are left out.
+    def entries(items):
+        return [(ss.paths["source"][key], ss.paths["destination"][key], directory, summary) for (key, directory), summary in items if key is not None]
+
+    try:
+        ss.journal.save(entries(ss.queue.queued()), entries(ss.in_flight.values()), force)
+    except (IOError, OSError) as e:
+        ss.debugger.error("failed to write journal %s: %s", (ss.state["journal"], e))
+
+# Queue what was waiting or being transferred when sucklesync last stopped,
+# so transfers can resume while the first scans are still running.
+def _restore_journal():
+    ss = sucklesync.sucklesync_instance
+
+    restored = ss.journal.load()
+    if not restored:
+        return
+
+    keys = dict(((source, destination), key) for key, (source, destination) in enumerate(zip(ss.paths["source"], ss.paths["destination"])))
+    queued, in_flight = restored
+    count = 0
+    # Interrupted transfers first, they have partial files waiting.
+    for source, destination, directory, summary in in_flight + queued:
+        key = keys.get((source, destination))
+        if key is None:
+            continue
+        _queue(key, directory, summary)
+        count += 1
+    ss.debugger.info("restored %d queued directories from %s", (count, ss.state["journal"]))
+
+# Show a cycle's breakdown in verbose mode, and log it if configured to.
+def _profiled(record):
+    ss = sucklesync.sucklesync_instance
+
+    if not record:
+        return
+
+    ss.debugger.info("cycle breakdown: %s", (profiler.summarize(record),))
+    if ss.profiling["log"]:
+        try:
+            profiler.append(ss.profiling["log"], record)
+        except (IOError, TypeError, ValueError) as e:
+            ss.debugger.error("failed to write profile to %s: %s", (ss.profiling["log"], e))
+
+# A remote agent for a host; it's started when first used.
+def _create_agent(host):
+    ss = sucklesync.sucklesync_instance
+    return agent.Agent(_ssh_command(agent.command(host["agent_python"]), host), ss.remote["ssh_timeout"])
+
+# The number of scanning and transfer threads needed for every host to run
+# its share of scans and transfers at once, as (scans, workers).
+def _pool_sizes():
+    ss = sucklesync.sucklesync_instance
+
+    paths = collections.Counter(ss.paths["host"])
+    scans = sum(min(ss.hosts[name]["scans"], count) for name, count in paths.iteritems())
+    workers = sum(host["workers"] for host in ss.hosts.itervalues())
+    return scans, workers
+
+# The names of the hosts whose connection changes with a new configuration,
+# or that are no longer configured.
+def _reconnect(fresh):
+    ss = sucklesync.sucklesync_instance
+
+    everything = _changed(fresh, "Local", CONNECTION_OPTIONS)
+    changed = set()
+    for name, host in ss.hosts.iteritems():
+        new = fresh.hosts.get(name)
+        if everything or not new or any(host[option] != new[option] for option in HOST_OPTIONS):
+            changed.add(name)
+    return changed
+
+# SIGHUP handler: ask the main loop to reload the configuration file.
+def _request_reload(signum, frame):
+    ss = sucklesync.sucklesync_instance
+    ss.reload = True
+    # Read the file again, even if an earlier reload is still waiting.
+    ss.reloaded = None
+
+# Returns True if any of the given options (by default, any option) of a
+# section differ between the running configuration and another.
+def _changed(fresh, section, options = None):
+    def values(configuration):
+        parser = configuration.parser
+        if not parser.has_section(section):
+            return {}
+        items = dict(parser.items(section, True))
+        if options is None:
+            return items
+        return dict((option, items.get(option)) for option in options)
+
+    ss = sucklesync.sucklesync_instance
+    return values(ss.configuration) != values(fresh.configuration)
+
+# Read the configuration file again, returning a SuckleSync holding it, or
+# None if it isn't valid.
+def _read_configuration():
+    ss = sucklesync.sucklesync_instance
+
+    fresh = SuckleSync(ss.config)
+    fresh.debugger = ss.debugger
+    fresh.verbose = ss.verbose
+    fresh.daemonize = ss.daemonize
+    try:
+        fresh._load_configuration()
+    except SystemExit:
+        # critical() exits, here it only means the new configuration is
+        # invalid, the running one is kept.
+        fresh = None
+    if fresh and not fresh.paths:
+        ss.debugger.error("misconfiguration in [Sucklepaths]")
+        fresh = None
+    if not fresh:
+        ss.debugger.error("not reloading invalid configuration, keeping the running one")
+    return fresh
+
+# Apply a configuration reload requested with SIGHUP. It's only applied
+# between scans and cleanups, and, if the connection to a remote host changes, once no
+# transfers are running on the old one. Returns (mapping, added) once a reload
+# has been applied, where mapping maps every previous sucklepath key to its
+# new key, or None if the sucklepath was removed, and added lists the keys of
+# new sucklepaths. Otherwise returns None.
+def _reload():
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.reload or ss.scanners.running or ss.cleaners.running:
+        return None
+    if not ss.reloaded:
+        ss.debugger.warning("reloading configuration")
+        ss.reloaded = _read_configuration()
+        if not ss.reloaded:
+            ss.reload = False
+            return None
+
+    fresh = ss.reloaded
+    reconnect = _reconnect(fresh)
+    if any(ss.transferring[name] for name in reconnect):
+        return None
+    ss.reload = False
+    ss.reloaded = None
+    return _apply_configuration(fresh, reconnect)
+
+# Switch to a new configuration, changing only what is affected. Sucklepaths
+# are matched by host, source and destination: a sucklepath that is still
+# configured keeps its queue, watcher, poll schedule and cleanup time, even if
+# its number changed. New sucklepaths are polled right away. Removed ones are
+# no longer scanned and their queued directories are dropped, but transfers
+# already running are allowed to finish.
+def _apply_configuration(fresh, reconnect):
+    ss = sucklesync.sucklesync_instance
+
+    previous = zip(ss.paths["host"], ss.paths["source"], ss.paths["destination"])
+    paths = zip(fresh.paths["host"], fresh.paths["source"], fresh.paths["destination"])
+    keys = dict((path, key) for key, path in enumerate(paths))
+    mapping = dict((key, keys.get(path)) for key, path in enumerate(previous))
+    added = [key for key, path in enumerate(paths) if path not in set(previous)]
+
+    for key, path in enumerate(previous):
+        if mapping[key] is None:
+            ss.debugger.warning("no longer syncing %s:%s to %s", path)
+            ss.stats["queue_depth"].set(0, sucklepath=path[1])
+    for key in added:
+        ss.debugger.warning("now syncing %s:%s to %s", paths[key])
+    for section, options in RESTART_OPTIONS:
+        if _changed(fresh, section, options):
+            ss.debugger.warning("changes to [%s] take effect when sucklesync is restarted", (section,))
+
+    # Per-sucklepath state follows its sucklepath to its new key. Watchers are
+    # restarted (with a full walk) if the way they're run changed.
+    rewatch = _changed(fresh, "Remote", ("watch", "watch_command"))
+    kept = set(key for key in mapping if mapping[key] is not None and not rewatch and ss.paths["host"][key] not in reconnect)
+    watchers = {}
+    for key, watcher in ss.watchers.iteritems():
+        if key in kept:
+            watchers[mapping[key]] = watcher
+        else:
+            watcher.stop()
+    ss.watchers = watchers
+    ss.swept = dict((mapping[key], swept) for key, swept in ss.swept.iteritems() if key in kept)
+    ss.stability = dict((mapping[key], observed) for key, observed in ss.stability.iteritems() if mapping[key] is not None)
+    ss.cleaned = dict((mapping[key], cleaned) for key, cleaned in ss.cleaned.iteritems() if mapping[key] is not None)
+    ss.queue.remap(lambda item: (mapping[item[0]], item[1]) if mapping[item[0]] is not None else None)
+    for target, ((key, directory), summary) in ss.in_flight.items():
+        ss.in_flight[target] = ((mapping.get(key), directory), summary)
+    ss.polls.remap(mapping)
+    for key, state in ss.polling.iteritems():
+        if mapping[key] is None:
+            state["stage"] = "done"
+    ss.polling = dict((mapping[key], state) for key, state in ss.polling.iteritems() if mapping[key] is not None)
+    ss.waiting = [mapping[key] for key in ss.waiting if mapping[key] is not None]
+
+    reagent = set(reconnect)
+    for name, host in ss.hosts.iteritems():
+        new = fresh.hosts.get(name)
+        if not new or _changed(fresh, "Remote", ("ssh_timeout", "marker", "lock")) or host["agent"] != new["agent"] or host["agent_python"] != new["agent_python"]:
+            reagent.add(name)
+    for name in reagent:
+        if name in ss.agents:
+            ss.agents.pop(name).stop()
+    for name in reconnect:
+        if name in ss.connections:
+            ss.connections.pop(name).stop()
+    remail = _changed(fresh, "Email")
+    if remail and ss.mail["enabled"] and "email" in ss.mail:
+        ss.mail["email"].Stop()
+    state = ss.state
+
+    ss.configuration = fresh.configuration
+    ss.local = fresh.local
+    ss.remote = fresh.remote
+    ss.paths = fresh.paths
+    ss.frequency = fresh.frequency
+    ss.transfer = fresh.transfer
+    ss.bandwidth = fresh.bandwidth
+    # Leases and the control socket keep what they were started with.
+    ss.state = dict(fresh.state)
+    for option in dict(RESTART_OPTIONS)["State"]:
+        ss.state[option] = state[option]
+    ss.hosts = fresh.hosts
+    if ss.logging["level"] != fresh.logging["level"]:
+        ss.logging["level"] = fresh.logging["level"]
+        ss.debugger.setLevel(ss.logging["level"])
+
+    if remail:
+        ss.mail = fresh.mail
+        if ss.mail["enabled"]:
+            ss.mail["email"] = email.Email(ss)
+    for name, host in ss.hosts.iteritems():
+        if host["agent"] and name not in ss.agents:
+            ss.agents[name] = _create_agent(host)
+
+    scans, workers = _pool_sizes()
+    ss.scanners.resize(scans)
+    ss.cleaners.resize(scans)
+    ss.pool.resize(workers)
+    ss.queue.reprioritize(ss.transfer["policy"], lambda item: ss.paths["weight"][item[0]])
+    ss.budget.schedule = ss.bandwidth["schedule"]
+    ss.budget.minimum = ss.bandwidth["minimum_share"]
+    ss.polls.jitter = ss.frequency["jitter"] / 100.0
+    for key in range(len(ss.paths["source"])):
+        if key in added:
+            if _owned(key):
+                ss.polls.add(key, ss.paths["minimum_poll_delay"][key], ss.paths["maximum_poll_delay"][key])
+        else:
+            ss.polls.tune(key, ss.paths["minimum_poll_delay"][key], ss.paths["maximum_poll_delay"][key])
+
+    if ss.state["manifest"] != state["manifest"]:
+        ss.manifest = manifest.Manifest(ss.state["manifest"]) if ss.state["manifest"] else None
+    if ss.state["journal"] != state["journal"] or ss.state["journal_interval"] != state["journal_interval"]:
+        ss.journal = journal.Journal(ss.state["journal"], ss.state["journal_interval"]) if ss.state["journal"] else None
+    # Leases of removed sucklepaths are given back, new ones may be claimed.
+    _balance_leases(True)
+    _queue_depth()
+
+    ss.debugger.warning("reloaded configuration: %d sucklepath(s), %d added, %d removed", (len(paths), len(added), mapping.values().count(None)))
+    return mapping, added
+
+# Create everything the main loop needs.
+def _prepare():
+    import Queue
+    import os
+    import socket
+    import threading
+
+    ss = sucklesync.sucklesync_instance
 
     if ss.mail["enabled"]:
         ss.mail["email"] = email.Email(ss)
 
+    # Scans, transfers and cleanups run in their own pools, reporting back to
+    # the main loop through one queue of events.
+    ss.events = Queue.Queue()
+    scans, workers = _pool_sizes()
+    ss.scanners = pool.Pool(scans, ss.events, "scan")
+    ss.cleaners = pool.Pool(scans, ss.events, "cleanup")
+    ss.pool = pool.Pool(workers, ss.events)
+    ss.queue = transfer_queue.TransferQueue(ss.transfer["policy"])
+    ss.budget = bandwidth.Budget(ss.bandwidth["schedule"], ss.bandwidth["minimum_share"])
+
+    if ss.state["manifest"]:
+        ss.manifest = manifest.Manifest(ss.state["manifest"])
+
+    for name, host in ss.hosts.iteritems():
+        if host["agent"]:
+            ss.agents[name] = _create_agent(host)
+
+    if ss.state["journal"]:
+        ss.journal = journal.Journal(ss.state["journal"], ss.state["journal_interval"])
+
+    if ss.dedup["index"]:
+        ss.fingerprints = fingerprints.Index(ss.dedup["index"], ss.dedup["hash"])
+        indexer = threading.Thread(target=_index_destinations, name="index")
+        indexer.daemon = True
+        indexer.start()
+
+    if ss.state["leases"]:
+        instance = ss.state["instance"] or "%s-%d" % (socket.gethostname(), os.getpid())
+        ss.leases = lease.Leases(ss.state["leases"], instance, ss.state["lease_duration"])
+
+    if ss.monitoring["port"]:
+        try:
+            ss.exporter = metrics.Exporter(ss.metrics, ss.monitoring["address"], ss.monitoring["port"])
+            ss.exporter.start()
+            ss.debugger.info("serving metrics on http://%s:%d/metrics", (ss.monitoring["address"], ss.monitoring["port"]))
+        except Exception as e:
+            ss.debugger.error("failed to serve metrics on %s:%d: %s", (ss.monitoring["address"], ss.monitoring["port"], e))
+
+    if ss.state["control"]:
+        try:
+            ss.control = control.Server(ss.state["control"])
+            ss.control.start()
+            ss.debugger.info("listening for control requests on %s", (ss.state["control"],))
+        except (IOError, OSError, socket.error) as e:
+            ss.debugger.error("failed to listen for control requests on %s: %s", (ss.state["control"], e))
+            ss.control = None
+
+    if ss.profiling["cprofile"] and not os.path.isdir(ss.profiling["cprofile"]):
+        os.makedirs(ss.profiling["cprofile"])
+    ss.profiler = profiler.Profiler(ss.profiling["cprofile"], ss.profiling["cprofile_count"])
+
+    # Every sucklepath is polled on its own schedule, starting right away,
+    # or once its lease is claimed.
+    ss.polls = poll_scheduler.PollScheduler(ss.frequency["jitter"] / 100.0)
+    for key in range(len(ss.paths["source"])):
+        if _owned(key):
+            ss.polls.add(key, ss.paths["minimum_poll_delay"][key], ss.paths["maximum_poll_delay"][key])
+    _balance_leases(True)
+
+    if ss.journal:
+        _restore_journal()
+
+# The name of a sucklepath's lease.
+def _lease_name(key):
+    ss = sucklesync.sucklesync_instance
+    return ss.leases.name(ss.paths["host"][key], ss.paths["source"][key], ss.paths["destination"][key])
+
+# Returns True if this instance syncs a sucklepath: always, unless leases are
+# configured, in which case it must hold the sucklepath's lease.
+def _owned(key):
+    ss = sucklesync.sucklesync_instance
+    return not ss.leases or _lease_name(key) in ss.leases.held
+
+# Renew the leases held, then claim or give back leases so that every live
+# instance syncs its share of the sucklepaths. Runs every third of a lease,
+# unless forced.
+def _balance_leases(force = False):
+    import math
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.leases:
+        return
+    now = time.time()
+    if not force and now < ss.leases.renewal:
+        return
+    ss.leases.renewal = now + ss.leases.duration / 3.0
+
+    keys = dict((_lease_name(key), key) for key in range(len(ss.paths["source"])))
     try:
-        while run:
-            if timer:
-                # When no files are being transferred, sleep for greater and greater
-                # periods of time, up to a maximum.
-                if (timer.elapsed() < ss.frequency["minimum_poll_delay"]):
-                    if sleep_delay < ss.frequency["maximum_poll_delay"]:
-                        sleep_delay += ss.frequency["minimum_poll_delay"]
-                    if sleep_delay > ss.frequency["maximum_poll_delay"]:
-                        sleep_delay = ss.frequency["maximum_poll_delay"]
-                    ss.debugger.debug("sleeping %d seconds", (sleep_delay,))
-                    time.sleep(sleep_delay)
-                else:
-                    ss.debugger.info("last loop took %d seconds, resetting sleep_delay", (timer.elapsed(),))
-                    sleep_delay = 0
-            timer = simple_timer.Timer()
-
-            key = 0
-            for source in ss.paths["source"]:
-                # Build a list of files to transfer.
-                ss.debugger.info("polling %s ...", (source,))
-                initial_queue = []
-                queue = []
-                transferred = False
-                include_flags = "! " + ss.remote["find_flags"]
-                command = ss.local["ssh"] + " " + ss.remote["hostname"] + " " + ss.local["ssh_flags"] + " " + ss.remote["find"] + " " + source + " " + include_flags
-                include = _ssh(command)
-                command = ss.local["ssh"] + " " + ss.remote["hostname"] + " " + ss.local["ssh_flags"] + " " + ss.remote["find"] + " " + source + " " + ss.remote["find_flags"]
-                exclude = _ssh(command)
-
-                # We may be having connectivity issues, try again later.
-                if not include:
+        share = int(math.ceil(len(keys) / float(ss.leases.heartbeat(now))))
+        for name in list(ss.leases.held):
+            if name not in keys:
+                # Its sucklepath was removed by a reload.
+                ss.leases.release(name, now)
+            elif not ss.leases.renew(name, _lease_description(keys[name]), now):
+                _unclaimed(keys[name], "its lease was taken over")
+
+        held = sorted(keys[name] for name in ss.leases.held)
+        if len(held) > share:
+            # Another instance has joined. Hand over one sucklepath at a time,
+            # one that isn't being polled and has nothing being transferred.
+            busy = set(ss.polling)
+            busy.update(key for (key, directory), summary in ss.in_flight.itervalues())
+            idle = [key for key in held if key not in busy]
+            if idle:
+                ss.leases.release(_lease_name(idle[-1]), now)
+                _unclaimed(idle[-1], "it was handed over to another instance")
+        else:
+            for key in range(len(ss.paths["source"])):
+                if len(ss.leases.held) >= share:
                     break
+                if key not in held and ss.leases.claim(_lease_name(key), _lease_description(key), now):
+                    _claimed(key)
+    except (IOError, OSError) as e:
+        ss.debugger.error("failed to update leases in %s: %s", (ss.state["leases"], e))
+
+    # Without access to the directory, leases can't be renewed; once they
+    # expire, other instances may take over.
+    for name, expires in ss.leases.held.items():
+        if expires <= now:
+            del ss.leases.held[name]
+            if name in keys:
+                _unclaimed(keys[name], "its lease expired")
+    ss.stats["leases"].set(len(ss.leases.held))
+
+def _lease_description(key):
+    ss = sucklesync.sucklesync_instance
+    return ("%s:%s to %s" % (ss.paths["host"][key], ss.paths["source"][key], ss.paths["destination"][key])).decode("utf-8", "replace")
 
-                for line in include:
-                    subpath = re.sub(r"^" + re.escape(source), "", line)
-                    try:
-                        directory = subpath.split("/")[1]
-                        if directory[0] == ".":
-                            continue
-                        elif directory not in initial_queue:
-                            ss.debugger.info(" queueing %s ...", (directory,))
-                            initial_queue.append(directory)
-                    except:
-                        continue
-
-                if exclude:
-                    exclude_from_queue = []
-                    for line in exclude:
-                        subpath = re.sub(r"^" + re.escape(source), "", line)
-                        try:
-                            directory = subpath.split("/")[1]
-                            if directory[0] == ".":
-                                continue
-                            elif directory not in exclude_from_queue:
-                                exclude_from_queue.append(directory)
-                        except:
-                            continue
-                    for line in initial_queue:
-                        if line in exclude_from_queue:
-                            ss.debugger.info(" excluding from queue %s ...", (directory,))
-                        else:
-                            queue.append(line)
-                else:
-                    queue = initial_queue
-
-                # Now rsync the list one by one, allowing for useful emails.
-                subkey = 0
-                for directory in queue:
-                    # Sync queued list of directories.
-                    sync = ss.local["rsync"] + " " + ss.local["rsync_flags"]
-                    sync += " " + ss.remote["hostname"] + ':"' + source + "/"
-                    sync +=  re.escape(directory) + '"'
-                    sync += " " + ss.paths["destination"][key]
-                    output = _rsync(sync)
-
-                    synced = []
-                    transferred = False
-                    mail_text = "Successfully synchronized:\n"
-                    mail_html = "<html><title>successfully synchronized</title><body><p>Successfully synchronized:</p><ul>"
-                    prefix = True
-                    suffix = False
-                    for line in output:
-                        if prefix:
-                            if re.search("receiving(.*)file list", line):
-                                prefix = False
-                        elif suffix:
-                            mail_text += line
-                            mail_html += "<br />" + line
-                            ss.debugger.debug("stats: %s", (line,))
-                        else:
-                            try:
-                                if re.search("sent (.*) bytes", line):
-                                    suffix = True
-                                    mail_text += "\n" + line
-                                    mail_html += "</ul><p>" + line
-                                    continue
-                                directory_synced = line.split("/")[0]
-                                if directory_synced and directory_synced not in synced:
-                                    transferred = True
-                                    mail_text += " - " + directory_synced + "\n"
-                                    mail_html += "<li>" + directory_synced
-                                    ss.debugger.debug(" synced %s ...", (directory_synced,))
-                                    synced.append(directory_synced)
-                            except:
-                                # rsync suffix starts with a blank line
-                                suffix = True
-                                continue
-
-                    if transferred:
-                        mail_html += "</p>"
-
-                    # List up to three queued items.
-                    in_list = False
-                    if len(queue) > subkey + 1:
-                        in_list = True
-                        mail_text += "Next download:\n - " + queue[subkey + 1] + "\n"
-                        mail_html += "<hr /><p>Next download:<ul><li>" + queue[subkey + 1] + "</li>"
-                        ss.debugger.debug(" next up %s ... [%d of %d]", (queue[subkey + 1], len(queue), subkey))
-                    if in_list and len(queue) > subkey + 2:
-                        mail_text += queue[subkey + 2] + "\n"
-                        mail_html += "<li>" + queue[subkey + 2] + "</li>"
-                    if in_list and len(queue) > subkey + 3:
-                        mail_text += queue[subkey + 3] + "\n"
-                        mail_html += "<li>" + queue[subkey + 3] + "</li>"
-                    if in_list:
-                        mail_html += "</ul></p>"
-
-                    if transferred:
-                        mail_html += "</body></html>"
-                        ss.mail["email"].MailSend("[sucklesync] file copied", mail_text, mail_html)
-                        _cleanup(source, key)
-                    subkey += 1
-                if not transferred:
-                    _cleanup(source, key)
-                key += 1
+# Start syncing a sucklepath whose lease was claimed, polling it right away.
+def _claimed(key):
+    ss = sucklesync.sucklesync_instance
+    ss.debugger.warning("claimed %s, now syncing it", (_lease_description(key),))
+    ss.polls.add(key, ss.paths["minimum_poll_delay"][key], ss.paths["maximum_poll_delay"][key])
+
+# Stop syncing a sucklepath whose lease is no longer held: it's no longer
+# scanned and its queued directories are dropped, but transfers already
+# running are allowed to finish.
+def _unclaimed(key, reason):
+    ss = sucklesync.sucklesync_instance
+    ss.debugger.warning("no longer syncing %s, %s", (_lease_description(key), reason))
+    ss.polls.remove(key)
+    ss.queue.remap(lambda item: None if item[0] == key else item)
+    if key in ss.watchers:
+        ss.watchers.pop(key).stop()
+    ss.swept.pop(key, None)
+    ss.stability.pop(key, None)
+    _queue_depth()
+
+# Start scanning a sucklepath that is due. In watch mode, nothing is scanned if
+# nothing has changed.
+def _start_scan(key):
+    ss = sucklesync.sucklesync_instance
+    source = ss.paths["source"][key]
+    state = ss.polling[key]
+
+    ss.debugger.info("polling %s ...", (source,))
+    directories = None
+    if ss.remote["watch"]:
+        directories = _watched(key)
+        if directories is not None and not directories:
+            ss.debugger.debug(" no changes in %s", (source,))
+            state["stage"] = "scanned"
+            return
+    state["stage"] = "scanning"
+    state["directories"] = directories
+    ss.scanning[ss.paths["host"][key]] += 1
+    ss.scanners.submit(("scan", key), _scan_job, key, directories)
+
+# Start scanning the waiting sucklepaths whose host isn't already running its
+# share of scans; the others are left waiting.
+def _start_scans(waiting):
+    ss = sucklesync.sucklesync_instance
+
+    for key in list(waiting):
+        if not _owned(key):
+            waiting.remove(key)
+            ss.polling[key]["stage"] = "scanned"
+            continue
+        host = _host(key)
+        if ss.scanning[host["name"]] < host["scans"]:
+            waiting.remove(key)
+            _start_scan(key)
+
+# Clean up the sucklepaths whose scan is complete and whose directories have
+# all been transferred, then schedule their next poll. Cleanups run in the
+# background: not before, as rsync --delete would otherwise remove the
+# temporary files of the sucklepath's transfers in progress.
+def _settle():
+    ss = sucklesync.sucklesync_instance
+
+    busy = set(key for key, directory in ss.queue)
+    busy.update(key for (key, directory), summary in ss.in_flight.itervalues())
+    for key, state in ss.polling.items():
+        if state["stage"] != "scanned" or key in busy:
+            continue
+        if state["scan"] and ss.local["delete"] and _owned(key):
+            state["stage"] = "cleaning"
+            ss.cleaners.submit(("cleanup", key), _cleanup_job, key, state["scan"])
+        else:
+            _polled(key)
+
+# Clean up a sucklepath, in one of the cleanup threads, unless its lease was
+# lost since it was scanned.
+def _cleanup_job(key, result):
+    ss = sucklesync.sucklesync_instance
+
+    if not _owned(key):
+        return None
+    with ss.profiler.phase("cleanup"):
+        return _cleanup(ss.paths["source"][key], key, result)
+
+# Schedule the next poll of a sucklepath that has been polled. Sucklepaths with
+# directories queued or still changing are polled again soon, idle ones less
+# and less often. In watch mode polls are cheap, as only directories with
+# changes are walked.
+def _polled(key):
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    state = ss.polling.pop(key)
+    state["stage"] = "done"
+    ss.polls.reschedule(key, state["active"] or ss.remote["watch"])
+    if state["again"]:
+        ss.polls.poll_now(key)
+    ss.debugger.debug("polled %s in %d seconds", (ss.paths["source"][key], time.time() - state["started"]))
+    _dump_metrics()
+
+# Run one poll cycle: start polling the sucklepaths that are due, and handle
+# scans, transfers and cleanups as they complete until those polls, and any
+# left over from the previous cycle, are over. Each sucklepath goes its own
+# way: it's scanned as soon as it's due (and its host has a scan to spare), its
+# transfers start as soon as its scan completes, and it's cleaned up once
+# they're done, however busy the others are. Sucklepaths falling due during
+# the cycle are started right away too, but aren't waited for: polls still in
+# progress carry on in the next cycle, so a busy daemon still ends its cycles.
+# Returns the keys of the sucklepaths whose poll started in the cycle.
+def _poll():
+    from utils import simple_timer
+    import Queue
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    timer = simple_timer.Timer()
+    ss.profiler.start()
+
+    keys = []
+    # The polls the cycle waits for.
+    pending = None
+    in_flight = ss.in_flight
+    while True:
+        _balance_leases()
+        _handle_control()
+        reloaded = _reload()
+        if reloaded:
+            # Sucklepaths may have been renumbered, new ones are due
+            # right away.
+            mapping, added = reloaded
+            keys = [mapping[key] for key in keys if mapping[key] is not None]
+
+        started = []
+        for key in ss.polls.pop_due():
+            if key in ss.polling:
+                # Asked for while it's being polled: poll it again once
+                # this poll is over.
+                ss.polling[key]["again"] = True
+                continue
+            ss.polling[key] = {"stage": "waiting", "started": time.time(), "directories": None, "scan": None, "active": False, "again": False}
+            started.append(ss.polling[key])
+            if key not in keys:
+                keys.append(key)
+            ss.waiting.append(key)
+        if pending is None:
+            pending = ss.polling.values()
+        elif not pending:
+            # Only transfers were left over, wait for the first polls.
+            pending = started
+        _start_scans(ss.waiting)
+        with ss.profiler.phase("dispatch"):
+            _reshare_transfers()
+            _dispatch(in_flight)
+        _settle()
+        if pending:
+            if all(state["stage"] == "done" for state in pending):
+                break
+        elif not (ss.polling or ss.pool.running or len(ss.queue)):
+            break
+
+        try:
+            with ss.profiler.phase("wait"):
+                (kind, job), result = ss.events.get(True, 1)
+        except Queue.Empty:
+            continue
+
+        if kind == "scan":
+            ss.scanners.done()
+            ss.scanning[ss.paths["host"][job]] -= 1
+            state = ss.polling[job]
+            state["stage"] = "scanned"
+            state["scan"] = result
+            if _scanned(job, state["directories"], result):
+                state["active"] = True
+        elif kind == "cleanup":
+            ss.cleaners.done()
+            if job in ss.polling:
+                _polled(job)
+        else:
+            ss.pool.done()
+            name, targets = job
+            ss.transferring[name] -= 1
+            _transferred(in_flight, targets, result)
+        _queue_depth()
+        _save_journal()
+    _save_journal(True)
+
+    ss.debugger.info("polled %d sucklepath(s) in %d seconds", (len(keys), timer.elapsed()), sucklepaths=[ss.paths["source"][key] for key in keys], duration=timer.elapsed())
+    _profiled(ss.profiler.finish())
+    return keys
+
+# Stop everything left running in the background.
+def _shutdown():
+    ss = sucklesync.sucklesync_instance
+
+    # Don't leave scans and transfers running in the background, but note
+    # what was interrupted so it's resumed on the next start.
+    process.cancel_all()
+    if ss.journal:
+        _save_journal(True)
+    for watcher in ss.watchers.itervalues():
+        watcher.stop()
+    for remote in ss.agents.itervalues():
+        remote.stop()
+    for remote in ss.connections.itervalues():
+        remote.stop()
+    if ss.leases:
+        # Let other instances take over right away.
+        try:
+            ss.leases.release_all()
+        except (IOError, OSError) as e:
+            ss.debugger.error("failed to release leases in %s: %s", (ss.state["leases"], e))
+    if ss.control:
+        ss.control.stop()
+    if ss.exporter:
+        ss.exporter.stop()
+    if ss.mail["enabled"] and "email" in ss.mail:
+        ss.mail["email"].Stop()
+
+# Sleep for delay seconds, or until a control request arrives.
+def _sleep(delay):
+    import errno
+    import select
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.control:
+        time.sleep(delay)
+        return
+    try:
+        select.select([ss.control.wakeup], [], [], delay)
+    except select.error as e:
+        # A SIGHUP interrupts the sleep, so a reload is applied right away.
+        if e.args[0] != errno.EINTR:
+            raise
+
+# Answer the requests waiting on the control socket.
+def _handle_control():
+    ss = sucklesync.sucklesync_instance
+
+    if not ss.control:
+        return
+    for request, reply in ss.control.pending():
+        ss.debugger.debug("control request: %s", (request,))
+        try:
+            response = _control_request(request)
+        except Exception as e:
+            ss.debugger.dump_exception("_control_request() exception")
+            response = {"error": str(e)}
+        reply(response)
+
+def _control_request(request):
+    command = request.get("command")
+    if command == "status":
+        return _control_status()
+    elif command == "queue":
+        return _control_queue()
+    elif command == "transfers":
+        return _control_transfers()
+    elif command == "poll":
+        return _control_poll(request)
+    elif command == "prioritize":
+        return _control_prioritize(request)
+    return {"error": "unknown command: %s" % (command,)}
+
+# The key of the sucklepath a control request names, by its number (counting
+# from 1) or its source, or None if there is no such sucklepath.
+def _control_sucklepath(request):
+    ss = sucklesync.sucklesync_instance
+
+    sucklepath = request.get("sucklepath")
+    if isinstance(sucklepath, basestring) and sucklepath.isdigit():
+        sucklepath = int(sucklepath)
+    if isinstance(sucklepath, int):
+        if 1 <= sucklepath <= len(ss.paths["source"]):
+            return sucklepath - 1
+    elif isinstance(sucklepath, basestring):
+        sucklepath = sucklepath.encode("utf-8").rstrip("/")
+        for key, source in enumerate(ss.paths["source"]):
+            if source.rstrip("/") == sucklepath:
+                return key
+    return None
+
+def _control_item(key, directory, summary):
+    ss = sucklesync.sucklesync_instance
+    return {"sucklepath": key + 1, "source": ss.paths["source"][key], "directory": directory, "size": summary.size, "files": summary.files, "mtime": summary.mtime}
+
+def _control_status():
+    import os
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    now = time.time()
+    queued = collections.Counter(key for (key, directory), summary in ss.queue.queued())
+    transferring = collections.Counter(key for (key, directory), summary in ss.in_flight.itervalues())
+    sucklepaths = []
+    for key in range(len(ss.paths["source"])):
+        due = ss.polls.when(key)
+        sucklepaths.append({
+            "sucklepath": key + 1,
+            "host": ss.paths["host"][key],
+            "source": ss.paths["source"][key],
+            "destination": ss.paths["destination"][key],
+            "synced": _owned(key),
+            "queued": queued[key],
+            "transferring": transferring[key],
+            "next_poll": max(0, due - now) if due is not None else None,
+            "polling": ss.polling[key]["stage"] if key in ss.polling else None,
+        })
+    return {"pid": os.getpid(), "instance": ss.leases.instance if ss.leases else None, "queued": len(ss.queue), "transferring": len(ss.in_flight), "sucklepaths": sucklepaths}
+
+# The queued directories, in the order they'll be transferred.
+def _control_queue():
+    return {"queue": [_control_item(key, directory, summary) for (key, directory), summary in sucklesync.sucklesync_instance.queue.queued()]}
+
+# The directories being transferred, with the progress of their transfers.
+def _control_transfers():
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    now = time.time()
+    transfers = []
+    for target, ((key, directory), summary) in sorted(ss.in_flight.iteritems()):
+        if key is None:
+            # Its sucklepath was removed by a reload.
+            continue
+        transfer = _control_item(key, directory, summary)
+        transfer["destination"] = target
+        status = dict(ss.progress.get(target, {}))
+        for name in ("bytes", "percent", "rate", "eta"):
+            transfer[name] = status.get(name)
+        transfer["elapsed"] = now - status["started"] if "started" in status else None
+        transfers.append(transfer)
+    return {"transfers": transfers}
+
+# Poll a sucklepath right away, or, if it's being polled, again once that
+# poll is over.
+def _control_poll(request):
+    ss = sucklesync.sucklesync_instance
+
+    key = _control_sucklepath(request)
+    if key is None:
+        return {"error": "no such sucklepath: %s" % (request.get("sucklepath"),)}
+    if not _owned(key):
+        return {"error": "sucklepath %d is synced by another instance" % (key + 1,)}
+    if key in ss.polling:
+        # Polled again once the poll in progress is over.
+        ss.polling[key]["again"] = True
+        ss.debugger.info("polling %s again on request once its poll in progress is over", (ss.paths["source"][key],))
+        return {"sucklepath": key + 1, "source": ss.paths["source"][key], "deferred": True}
+    # The main loop picks it up right after answering.
+    ss.polls.poll_now(key)
+    ss.debugger.info("polling %s on request", (ss.paths["source"][key],))
+    return {"sucklepath": key + 1, "source": ss.paths["source"][key], "deferred": False}
+
+# Move a queued directory to the front of the queue.
+def _control_prioritize(request):
+    ss = sucklesync.sucklesync_instance
+
+    key = _control_sucklepath(request)
+    if key is None:
+        return {"error": "no such sucklepath: %s" % (request.get("sucklepath"),)}
+    directory = request.get("directory")
+    if not isinstance(directory, basestring):
+        return {"error": "no directory given"}
+    directory = directory.encode("utf-8").strip("/")
+    if not ss.queue.promote((key, directory)):
+        if any(item == (key, directory) for item, summary in ss.in_flight.itervalues()):
+            return {"error": "%s is already being transferred" % (directory,)}
+        return {"error": "%s is not queued" % (directory,)}
+    ss.debugger.info("moved %s of %s to the front of the queue", (directory, ss.paths["source"][key]))
+    _save_journal()
+    return {"sucklepath": key + 1, "source": ss.paths["source"][key], "directory": directory}
+
+def sucklesync():
+    import signal
+    import time
+
+    ss = sucklesync.sucklesync_instance
+
+    run = True
+
+    _prepare()
+    signal.signal(signal.SIGHUP, _request_reload)
+
+    try:
+        while run:
+            _reload()
+            _balance_leases()
+            _handle_control()
+
+            # Polls and transfers still in progress carry on right away.
+            if ss.polling or ss.pool.running or len(ss.queue):
+                _poll()
+                continue
+
+            # Sleep until the next sucklepath is due, the leases are to be
+            # renewed, or a control request arrives. A SIGHUP cuts the sleep
+            # short, so a reload is applied right away.
+            due = ss.polls.next_due()
+            if ss.leases:
+                due = min(due or ss.leases.renewal, ss.leases.renewal)
+            delay = due - time.time()
+            if delay > 0:
+                ss.debugger.debug("sleeping %d seconds", (delay,))
+                _sleep(delay)
+                continue
+            _poll()
 
     except Exception as e:
         ss.debugger.dump_exception("sucklesync() exception")
+
+    finally:
+        # Also reached when daemonize exits on SIGTERM.
+        _shutdown()
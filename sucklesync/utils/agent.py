@@ -0,0 +1,223 @@
+import collections
+import itertools
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import zlib
+
+from sucklesync import remote_agent
+from sucklesync.utils import process
+from sucklesync.utils import scan
+
+# Run on the remote server to start the agent: python reads the agent's source
+# from stdin and runs it, and the agent then reads requests from the same stdin.
+BOOTSTRAP = "import sys;exec(getattr(sys.stdin,'buffer',sys.stdin).read(%d))"
+
+_source = None
+
+class AgentError(Exception):
+    pass
+
+def _agent_source():
+    global _source
+    if _source is None:
+        path = remote_agent.__file__
+        if path.endswith((".pyc", ".pyo")):
+            path = path[:-1]
+        with open(path, "rb") as f:
+            _source = f.read()
+    return _source
+
+# The remote command that starts the agent with the given python.
+def command(python):
+    try:
+        from shlex import quote as cmd_quote
+    except ImportError:
+        from pipes import quote as cmd_quote
+
+    return python + " -c " + cmd_quote(BOOTSTRAP % len(_agent_source()))
+
+# Talks to the remote agent (see remote_agent.py), kept running on one ssh
+# session, to summarize sources on the remote server. The summaries of every
+# source are cached here, so each scan only brings back the top-level
+# directories that changed since the previous one, rather than a line per file.
+# Requests from several threads can be outstanding at once.
+class Agent:
+    def __init__(self, command, timeout = None):
+        self.command = command
+        # Seconds to wait for the agent to start.
+        self.timeout = timeout
+        self.process = None
+        self.python = None
+        self.closed = True
+        self.lock = threading.Lock()
+        # Held while deciding whether to (re)start the agent.
+        self.starting = threading.Lock()
+        self.ids = itertools.count(1)
+        self.waiting = {}
+        self.trees = {}
+        self._stderr = collections.deque(maxlen=process.STDERR_LINES)
+
+    def alive(self):
+        return not self.closed
+
+    # Start the agent, raising AgentError if it doesn't answer.
+    def start(self):
+        argv = shlex.split(self.command)
+        try:
+            # In its own process group, like process.Stream.
+            self.process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        except OSError as e:
+            raise AgentError("failed to run %s: %s" % (argv[0], e))
+        process.count(argv)
+        process.track(self)
+
+        # A new agent knows nothing about earlier scans.
+        self.trees = {}
+        self._stderr.clear()
+        self.closed = False
+        for target in (self._read, self._read_stderr):
+            thread = threading.Thread(target=target, name="agent")
+            thread.daemon = True
+            thread.start()
+
+        try:
+            self.process.stdin.write(_agent_source())
+            self.process.stdin.flush()
+            reply, size = self._call({"op": "hello"}, self.timeout)
+        except (AgentError, IOError, OSError):
+            reply = None
+        if not reply or reply.get("version") != remote_agent.VERSION:
+            self.cancel()
+            if reply:
+                raise AgentError("agent version %s doesn't match %s" % (reply.get("version"), remote_agent.VERSION))
+            raise AgentError("agent failed to start: %s" % self.stderr())
+        self.python = reply.get("python")
+
+    def stop(self):
+        if self.closed:
+            return
+        try:
+            with self.lock:
+                remote_agent.write_frame(self.process.stdin, {"op": "quit"})
+            self.process.stdin.close()
+        except (IOError, OSError, ValueError):
+            pass
+        for attempt in range(10):
+            if self.process.poll() is not None:
+                return
+            threading.Event().wait(0.1)
+        self.cancel()
+
+    # Kill the agent from another thread, e.g. when shutting down.
+    def cancel(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def stderr(self):
+        return "\n".join(self._stderr)
+
+    # Scan a source, or only the listed directories, returning a scan.Scan like
+    # a walk with find would, or None if the agent didn't reply within timeout
+    # seconds. Raises AgentError if the agent failed.
+    def summaries(self, source, directories = None, timeout = None, marker = None, lock = None):
+        cached = self.trees.get(source)
+        request = {"op": "summaries", "source": remote_agent.encode_path(source), "since": cached[0] if cached else None}
+        if directories is not None:
+            request["directories"] = [remote_agent.encode_path(directory) for directory in directories]
+        _names(request, marker, lock)
+        reply, size = self._call(request, timeout)
+        if reply is None:
+            return None
+
+        summaries = dict(cached[1]) if cached else {}
+        for name, values in reply["changed"].iteritems():
+            summaries[remote_agent.decode_path(name)] = _summary(*values)
+        for name in reply["removed"]:
+            summaries.pop(remote_agent.decode_path(name), None)
+        self.trees[source] = (reply["generation"], summaries)
+
+        result = scan.Scan(source, directories, marker, lock)
+        result.entries = reply["entries"]
+        result.complete = reply["complete"]
+        result.received = size
+        result.now = reply.get("now")
+        names = summaries if directories is None else [directory for directory in directories if directory in summaries]
+        for name in sorted(names):
+            result.summaries[name] = summaries[name]
+        return result
+
+    # Send a request and wait up to timeout seconds for its reply. Returns
+    # (reply, size in bytes), or (None, 0) if there was no reply in time.
+    def _call(self, request, timeout):
+        waiter = [threading.Event(), None]
+        with self.lock:
+            if self.closed:
+                raise AgentError("agent isn't running")
+            request["id"] = next(self.ids)
+            self.waiting[request["id"]] = waiter
+            try:
+                remote_agent.write_frame(self.process.stdin, request)
+            except (IOError, OSError, ValueError) as e:
+                del self.waiting[request["id"]]
+                raise AgentError("failed to send request to agent: %s" % e)
+
+        waiter[0].wait(timeout)
+        with self.lock:
+            self.waiting.pop(request["id"], None)
+        if not waiter[0].is_set():
+            return None, 0
+        if waiter[1] is None:
+            raise AgentError("agent exited: %s" % self.stderr())
+        reply, size = waiter[1]
+        if "error" in reply:
+            raise AgentError(reply["error"])
+        return reply, size
+
+    # Hand every reply to the thread waiting for it. Once the agent exits, any
+    # thread still waiting is woken up without a reply.
+    def _read(self):
+        try:
+            while True:
+                reply, size = remote_agent.read_frame(self.process.stdout)
+                if reply is None:
+                    break
+                with self.lock:
+                    waiter = self.waiting.get(reply.get("id"))
+                    if waiter:
+                        waiter[1] = (reply, size)
+                        waiter[0].set()
+        except (IOError, OSError, ValueError, EOFError, zlib.error):
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                for waiter in self.waiting.itervalues():
+                    waiter[0].set()
+            self.cancel()
+            self.process.wait()
+            process.untrack(self)
+
+    def _read_stderr(self):
+        for line in iter(self.process.stderr.readline, ""):
+            self._stderr.append(line.rstrip("\n"))
+
+def _summary(mtime, size, files, marker = False, locked = False):
+    summary = scan.Summary()
+    summary.mtime = float(mtime)
+    summary.size = int(size)
+    summary.files = int(files)
+    summary.marker = bool(marker)
+    summary.locked = bool(locked)
+    return summary
+
+# Ask the agent to look for marker and lock files.
+def _names(request, marker, lock):
+    if marker:
+        request["marker"] = remote_agent.encode_path(marker)
+    if lock:
+        request["lock"] = remote_agent.encode_path(lock)
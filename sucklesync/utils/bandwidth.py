@@ -0,0 +1,104 @@
+import re
+import time
+
+WINDOW = re.compile(r"^\s*([0-9]{1,2}):([0-9]{2})\s*-\s*([0-9]{1,2}):([0-9]{2})\s+([0-9]+)\s*$")
+
+# A time-of-day bandwidth schedule, such as "08:00-18:00 1000, 18:00-08:00 0":
+# comma separated windows, each with a limit in KB per second (as used by
+# rsync's --bwlimit, 0 for unlimited). Windows may wrap around midnight; the
+# first that matches applies, outside of them the default limit does.
+class Schedule:
+    def __init__(self, text = None, default = 0):
+        self.default = default
+        self.windows = []
+        if not text:
+            return
+
+        for window in text.split(","):
+            match = WINDOW.match(window)
+            if not match:
+                raise ValueError("invalid bandwidth window '%s', expected HH:MM-HH:MM LIMIT" % window.strip())
+            start_hour, start_minute, end_hour, end_minute, limit = [int(value) for value in match.groups()]
+            if start_hour > 23 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+                raise ValueError("invalid time in bandwidth window '%s'" % window.strip())
+            self.windows.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute, limit))
+
+    # The limit in effect at a time (local time, seconds since the epoch).
+    def limit(self, now = None):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, limit in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return limit
+            elif minute >= start or minute < end:
+                return limit
+        return self.default
+
+# One bandwidth budget shared by every transfer. A transfer's share is fixed
+# when it starts (rsync can't change its --bwlimit later), so each new transfer
+# is given an equal part of the budget for the transfers expected to run at
+# once, but never more than what the running transfers leave over. Shares are
+# handed back as transfers finish. When the schedule changes the limit much,
+# the transfers whose share no longer suits it are to be restarted with a new
+# one.
+class Budget:
+    def __init__(self, schedule, minimum = 0):
+        self.schedule = schedule
+        self.minimum = minimum
+        self.allocated = {}
+        # Transfers running without a limit.
+        self.unlimited = set()
+        # The limit in effect as of the last call to outdated().
+        self.current = None
+
+    # The share for a transfer starting now, with expected transfers (including
+    # this one) likely to run at once: 0 if bandwidth is unlimited, or None if
+    # what running transfers leave is below the minimum share and the transfer
+    # should wait for them.
+    def share(self, expected, now = None):
+        budget = self.schedule.limit(now)
+        if not budget:
+            return 0
+
+        remaining = budget - sum(self.allocated.itervalues())
+        share = min(remaining, budget // max(1, expected))
+        if share >= max(1, self.minimum):
+            return share
+        if not self.allocated:
+            # Never leave the link idle waiting for a bigger share.
+            return max(1, min(budget, max(share, self.minimum)))
+        return None
+
+    def acquire(self, job, share):
+        if share:
+            self.allocated[job] = share
+        else:
+            self.unlimited.add(job)
+
+    def release(self, job):
+        self.allocated.pop(job, None)
+        self.unlimited.discard(job)
+
+    # The running transfers to restart, if the limit has changed since the last
+    # call. When it's lifted or at least doubled, those held to a limit, so they
+    # can speed up. Otherwise, those taking more than it allows: those running
+    # without a limit, and those with the largest shares, until the rest fit
+    # within it.
+    def outdated(self, now = None):
+        budget = self.schedule.limit(now)
+        previous = self.current
+        if budget == previous:
+            return []
+        self.current = budget
+        if not budget or (previous and budget >= 2 * previous):
+            return list(self.allocated)
+
+        jobs = list(self.unlimited)
+        kept = 0
+        for job, share in sorted(self.allocated.iteritems(), key=lambda item: item[1]):
+            if kept + share <= budget:
+                kept += share
+            else:
+                jobs.append(job)
+        return jobs
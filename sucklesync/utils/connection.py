@@ -0,0 +1,120 @@
+import os
+import stat
+import subprocess
+import threading
+import time
+
+from sucklesync.utils import process
+
+# Manage one long-lived OpenSSH ControlMaster connection to a remote host. Every
+# ssh and rsync command adds options() to reuse it rather than performing a new
+# key exchange and authentication. If the master isn't running, ssh falls back
+# to making a direct connection, so a dead master only costs performance.
+class Connection:
+    def __init__(self, ss, hostname, port = None, username = None, ssh_flags = None):
+        try:
+            from shlex import quote as cmd_quote
+        except ImportError:
+            from pipes import quote as cmd_quote
+
+        self.ss = ss
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.ssh_flags = ss.local["ssh_flags"] if ssh_flags is None else ssh_flags
+        self.enabled = ss.local["multiplex"]
+        # Scans of several sucklepaths on the host may want it at once.
+        self.lock = threading.Lock()
+
+        name = "sucklesync-%d-%s@%s:%s" % (os.getuid(), username or "", hostname, port or "")
+        self.path = os.path.join(ss.local["control_directory"], name)
+        self.socket = cmd_quote(self.path)
+
+        self.target = ""
+        if port:
+            self.target += " -p %d" % port
+        if username:
+            self.target += " -l " + cmd_quote(username)
+
+    # Options that make an ssh client reuse the master connection.
+    def options(self):
+        if not self.enabled:
+            return self.target
+        return self.target + " -S " + self.socket + " -o ControlMaster=no"
+
+    # Returns True if the master connection is up and accepting sessions.
+    def check(self):
+        if not self.enabled:
+            return True
+        return self._call(" -S " + self.socket + " -O check " + self.hostname) == 0
+
+    def start(self):
+        if not self.enabled:
+            return True
+
+        try:
+            self._private_directory(os.path.dirname(self.path))
+        except OSError as e:
+            self.ss.debugger.error("failed to create control directory for %s (%s), connecting directly", (self.hostname, e))
+            return False
+
+        self.ss.debugger.info("opening master connection to %s", (self.hostname,))
+        command = " " + self.ssh_flags + self.target
+        command += " -M -N -f -S " + self.socket
+        command += " -o ServerAliveInterval=%d -o ServerAliveCountMax=3" % self.ss.local["multiplex_keepalive"]
+        command += " " + self.hostname
+        if self._call(command, self.ss.remote["ssh_timeout"]) == 0:
+            return True
+
+        self.ss.debugger.error("failed to open master connection to %s, connecting directly", (self.hostname,))
+        return False
+
+    # Health check, (re)establishing the master connection if it has gone away.
+    def ensure(self):
+        with self.lock:
+            if self.check():
+                return True
+            return self.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+
+        if os.path.exists(self.path):
+            self.ss.debugger.info("closing master connection to %s", (self.hostname,))
+            self._call(" -S " + self.socket + " -O exit " + self.hostname)
+
+    # Create the directory holding the control socket, only accessible to this
+    # user, so nobody else can put a socket of their own at its path.
+    def _private_directory(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+            return
+        if os.stat(directory).st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            self.ss.debugger.warning("control_directory %s is writable by other users, another user could take over the path of the control socket", (directory,))
+
+    # Run ssh with the given arguments, returning its exit code or None if it
+    # did not complete within timeout seconds. The master forks into the
+    # background, so output is discarded rather than read from a pipe.
+    def _call(self, arguments, timeout = None):
+        import shlex
+
+        command = self.ss.local["ssh"] + arguments
+        self.ss.debugger.debug("_call: %s", (command,))
+        argv = shlex.split(command)
+        try:
+            with open(os.devnull, "r+") as devnull:
+                ssh = subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+                process.count(argv)
+                if timeout:
+                    deadline = time.time() + timeout
+                    while ssh.poll() is None:
+                        if time.time() > deadline:
+                            ssh.kill()
+                            ssh.wait()
+                            return None
+                        time.sleep(0.1)
+                return ssh.wait()
+        except OSError as e:
+            self.ss.debugger.error("failed to run ssh (%s): %s", (e, command))
+            return None
@@ -0,0 +1,143 @@
+import Queue
+import errno
+import fcntl
+import json
+import os
+import socket
+import threading
+
+# Seconds a client waits for the daemon to answer.
+TIMEOUT = 30
+
+# A Unix domain socket the daemon answers control requests on. Each
+# connection carries one request, a line of JSON, and gets one line of JSON
+# back. Requests are handled by the main loop, which owns the daemon's state:
+# connections are accepted in a background thread, their requests queued,
+# and the main loop woken up through a pipe it can select() on along with its
+# sleep.
+class Server:
+    def __init__(self, path):
+        self.path = path
+        self.requests = Queue.Queue()
+
+        # Replace a socket left behind by a daemon that didn't clean up.
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created accessible to this user only, so no one else can connect
+        # before its permissions are set.
+        umask = os.umask(0177)
+        try:
+            self.socket.bind(path)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0600)
+        self.socket.listen(5)
+
+        self.wakeup, self.waker = os.pipe()
+        for fd in (self.wakeup, self.waker):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.thread = threading.Thread(target=self._accept, name="control")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        try:
+            self.socket.close()
+            os.unlink(self.path)
+        except (IOError, OSError, socket.error):
+            pass
+
+    # The requests waiting to be handled, as (request, reply) where reply is
+    # called with the response.
+    def pending(self):
+        try:
+            while os.read(self.wakeup, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        requests = []
+        while True:
+            try:
+                requests.append(self.requests.get_nowait())
+            except Queue.Empty:
+                return requests
+
+    def _accept(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except socket.error:
+                # The socket was closed.
+                return
+            thread = threading.Thread(target=self._serve, args=(connection,), name="control")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        try:
+            connection.settimeout(TIMEOUT)
+            stream = connection.makefile("rw")
+            try:
+                request = json.loads(stream.readline())
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+            except ValueError as e:
+                response = {"error": "invalid request: %s" % e}
+            else:
+                answered = threading.Event()
+                holder = []
+                def reply(response):
+                    holder.append(response)
+                    answered.set()
+                self.requests.put((request, reply))
+                try:
+                    os.write(self.waker, "x")
+                except OSError:
+                    # The pipe is full, the main loop is already due to wake up.
+                    pass
+                answered.wait(TIMEOUT)
+                response = holder[0] if holder else {"error": "no response from the main loop"}
+            try:
+                line = json.dumps(_text(response), default=str)
+            except (ValueError, UnicodeError) as e:
+                line = json.dumps({"error": "failed to encode response: %s" % e})
+            stream.write(line + "\n")
+            stream.flush()
+        except (IOError, socket.error):
+            pass
+        finally:
+            connection.close()
+
+# Paths are byte strings, not necessarily UTF-8: bytes that aren't are shown
+# as replacement characters rather than failing the whole response.
+def _text(value):
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    if isinstance(value, dict):
+        return dict((_text(key), _text(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_text(item) for item in value]
+    return value
+
+# Send a request to the daemon listening on path, returning its response.
+# Raises socket.error if the daemon can't be reached.
+def request(path, message, timeout = TIMEOUT):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(timeout)
+        connection.connect(path)
+        stream = connection.makefile("rw")
+        stream.write(json.dumps(message) + "\n")
+        stream.flush()
+        response = stream.readline()
+        if not response:
+            raise socket.error("connection closed without a response")
+        return json.loads(response)
+    finally:
+        connection.close()
@@ -1,7 +1,10 @@
+import Queue
+import atexit
 import logging
 import sys
 import pwd
 import os
+import threading
 
 ALWAYS   = 0
 VERBOSE  = 1
@@ -24,7 +27,14 @@ FILE     = 1
 
 debugger_instance = None
 
+SEVERITIES = (DEBUG, DEBUG2, DEBUG3, INFO, INFO2, WARNING, ERROR, CRITICAL)
+
 # mode: PRINT or FILE
+#
+# Whether each severity is logged at all is worked out whenever the mode,
+# verbosity or level changes, so messages that won't be logged cost a single
+# lookup, without formatting anything. In FILE mode, and for the optional JSON
+# lines log, records are handed to a background thread to format and write.
 class Debugger:
     def __init__(self, verbose = False, logger = None, mode = PRINT, level = logging.CRITICAL):
         if verbose:
@@ -35,9 +45,15 @@ class Debugger:
         self.logger = logger
         self.mode = mode
         self.level = level
+        self.json = None
+        self.queue = Queue.Queue()
+        self.writer = None
+        self.enabled = frozenset()
 
         if logger:
             self.logger.setLevel(self.level)
+        self._update()
+        atexit.register(self.flush)
 
     def dump_exception(self, message = None, is_error = True):
         import os
@@ -62,18 +78,44 @@ class Debugger:
             else:
                 self.info("%s", (message,))
 
-    def log(self, message, args, severity):
+    # Work out which severities are logged.
+    def _update(self):
+        threshold = None
+        if self.logger and (self.mode == FILE or self.json):
+            threshold = self.logger.getEffectiveLevel()
+
+        enabled = set()
+        for severity in SEVERITIES:
+            level, verbose, fatal = severity
+            if fatal:
+                enabled.add(severity)
+            elif threshold is not None and level >= threshold:
+                enabled.add(severity)
+            elif self.mode == PRINT and ((self.verbose and verbose >= self.verbose) or (verbose == ALWAYS)):
+                enabled.add(severity)
+        self.enabled = frozenset(enabled)
+
+    # fields: optional structured data, such as sucklepath, directory, duration
+    # or bytes, included in the JSON lines log.
+    def log(self, message, args, severity, fields = None):
+        if severity not in self.enabled:
+            return
+
         try:
             level, verbose, fatal = severity
-            if self.mode == FILE:
-                if not self.logger:
-                    self.mode = PRINT
-                    self.log(message, args, logging.CRITICAL)
-                    self.fatal("fatal error, no logger provided, exiting")
-                if args:
-                    self.logger.log(level, message, *args)
-                else:
-                    self.logger.log(level, message)
+            if self.mode == FILE and not self.logger:
+                self.mode = PRINT
+                self._update()
+                self.log(message, args, CRITICAL)
+                self.fatal("fatal error, no logger provided, exiting")
+
+            if self.mode == FILE or self.json:
+                # The record is created now, so it carries the right time and
+                # thread; formatting and writing it is left to the writer.
+                if self.logger.isEnabledFor(level):
+                    record = self.logger.makeRecord(self.logger.name, level, "(unknown file)", 0, message, args or (), None)
+                    self._start()
+                    self.queue.put((record, fields, self.mode == FILE))
 
             if self.mode == PRINT:
                 if ((self.verbose and verbose >= self.verbose) or (verbose == ALWAYS)):
@@ -83,11 +125,50 @@ class Debugger:
                         print message
 
             if fatal:
+                self.flush()
                 self.fatal("fatal error: exiting")
 
         except Exception as e:
             print "%s" % e
 
+    # Start the writer, again if needed: threads don't survive daemonizing.
+    def _start(self):
+        if self.writer and self.writer.is_alive():
+            return
+        self.writer = threading.Thread(target=self._write, name="log")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _write(self):
+        import json
+
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading._Event):
+                item.set()
+                continue
+
+            record, fields, to_logger = item
+            try:
+                if to_logger:
+                    self.logger.handle(record)
+                if self.json:
+                    entry = {"time": record.created, "level": record.levelname, "thread": record.threadName, "message": record.getMessage()}
+                    if fields:
+                        entry.update(fields)
+                    self.json.write(json.dumps(entry, default=str) + "\n")
+                    self.json.flush()
+            except Exception as e:
+                print "%s" % e
+
+    # Wait up to timeout seconds for queued records to be written.
+    def flush(self, timeout = 5):
+        if not self.writer or not self.writer.is_alive():
+            return
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait(timeout)
+
     # Determine who we are, for pretty logging.
     def whoami(self):
         whoami = pwd.getpwuid(os.getuid())
@@ -96,35 +177,50 @@ class Debugger:
 
     def setLevel(self, level):
         self.level = level
-        if self.mode == FILE:
+        if self.logger:
             self.logger.setLevel(level)
+        self._update()
 
     def logToFile(self):
         self.mode = FILE
+        self._update()
+
+    # Also write every record to filename as a line of JSON.
+    def logToJson(self, filename):
+        self.json = open(filename, "a")
+        self._update()
 
-    def debug(self, message, args = None):
-        self.log(message, args, DEBUG)
+    def debug(self, message, args = None, **fields):
+        if DEBUG in self.enabled:
+            self.log(message, args, DEBUG, fields)
 
-    def debug2(self, message, args = None):
-        self.log(message, args, DEBUG2)
+    def debug2(self, message, args = None, **fields):
+        if DEBUG2 in self.enabled:
+            self.log(message, args, DEBUG2, fields)
 
-    def debug3(self, message, args = None):
-        self.log(message, args, DEBUG3)
+    def debug3(self, message, args = None, **fields):
+        if DEBUG3 in self.enabled:
+            self.log(message, args, DEBUG3, fields)
 
-    def info(self, message, args = None):
-        self.log(message, args, INFO)
+    def info(self, message, args = None, **fields):
+        if INFO in self.enabled:
+            self.log(message, args, INFO, fields)
 
-    def info2(self, message, args = None):
-        self.log(message, args, INFO2)
+    def info2(self, message, args = None, **fields):
+        if INFO2 in self.enabled:
+            self.log(message, args, INFO2, fields)
 
-    def warning(self, message, args = None):
-        self.log(message, args, WARNING)
+    def warning(self, message, args = None, **fields):
+        if WARNING in self.enabled:
+            self.log(message, args, WARNING, fields)
 
-    def error(self, message, args = None):
-        self.log(message, args, ERROR)
+    def error(self, message, args = None, **fields):
+        if ERROR in self.enabled:
+            self.log(message, args, ERROR, fields)
 
-    def critical(self, message, args = None):
-        self.log(message, args, CRITICAL)
+    def critical(self, message, args = None, **fields):
+        if CRITICAL in self.enabled:
+            self.log(message, args, CRITICAL, fields)
 
     def fatal(self, message, args = None):
         if args:
@@ -1,14 +1,36 @@
 from sucklesync.utils import debug
 
+import Queue
+import os
+import smtplib
+import socket
+import threading
+import time
+
 email_instance = None
 
+# Notifications waiting to be sent; any more are dropped.
+QUEUE_SIZE = 1000
+# Close the SMTP connection after it has been idle this many seconds.
+IDLE_TIMEOUT = 60
+SMTP_TIMEOUT = 30
+# How often to retry sending spooled messages.
+RETRY_INTERVAL = 300
+
+STOP = object()
+
 class Email:
     def __init__(self, ss):
         from sucklesync import sucklesync
         self.ss = ss
+        self.smtp = None
+        self.used = 0
+        self.retried = 0
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.thread = None
 
         if not self.ss.mail["enabled"]:
-            debugger.warning("email is disabled")
+            self.ss.debugger.warning("email is disabled")
             return
 
         try:
@@ -34,18 +56,201 @@ class Email:
             self.ss.debugger.warning("ignoring invalid email mode (%s), must be one of: normal, ssl, tls", (self.ss.mail["mode"],))
             self.ss.mail["mode"] = "normal"
 
+        if self.ss.mail["spool"] and not os.path.isdir(self.ss.mail["spool"]):
+            os.makedirs(self.ss.mail["spool"])
+
+        # Mail is sent from a background thread, so a slow or unreachable
+        # server never holds up transfers.
+        self.thread = threading.Thread(target=self._run, name="email")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a notification, returning right away. Notifications are sent on
+    # their own or combined into digests of up to digest_count, sent at the
+    # latest digest_interval seconds after the first was queued. Only the
+    # trailer (text, html) of the most recent notification in a digest is
+    # included. The html should be a fragment, without <html> or <body>.
+    def Notify(self, subject, body_text, body_html, trailer = None):
+        if not self.thread:
+            return
+
+        try:
+            self.queue.put_nowait((subject, body_text, body_html, trailer))
+        except Queue.Full:
+            self.ss.debugger.warning("email queue is full, dropping notification: %s", (subject,))
+
+    # Send what is still queued, waiting up to timeout seconds.
+    def Stop(self, timeout = 10):
+        if not self.thread:
+            return
+
+        try:
+            self.queue.put(STOP, True, timeout)
+        except Queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    # Send a message now, reusing the open SMTP connection. Returns True if it
+    # was accepted by the server. Messages that couldn't be sent are spooled,
+    # if configured to, or dropped.
     def MailSend(self, subject, body_text, body_html):
         try:
             import pyzmail
             payload, mail_from, rcpt_to, msg_id = pyzmail.generate.compose_mail(self.ss.mail["from"], self.ss.mail["to"], subject, "iso-8859-1", (body_text, "us-ascii"), (body_html, "us-ascii"))
-            ret = pyzmail.generate.send_mail(payload, mail_from, rcpt_to, self.ss.mail["hostname"], self.ss.mail["port"], self.ss.mail["mode"], self.ss.mail["username"], self.ss.mail["password"])
+        except Exception as e:
+            self.ss.debugger.dump_exception("MailSend() exception")
+            return False
+
+        if self._send(payload, mail_from, rcpt_to):
+            return True
+
+        if self.ss.mail["spool"]:
+            self._spool(payload)
+        else:
+            self.ss.debugger.warning("dropping email: %s", (subject,))
+        return False
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            try:
+                item = self.queue.get(True, 1)
+            except Queue.Empty:
+                item = None
 
-            if isinstance(ret, dict):
-                if ret:
-                    failed_recipients = ", ".join(ret.keys())
-                    self.ss.debugger.warning("failed to send email, failed receipients: %s", (failed_recipients,))
+            now = time.time()
+            if item is not None and item is not STOP:
+                if not pending:
+                    deadline = now + self.ss.mail["digest_interval"]
+                pending.append(item)
+
+            if pending and (item is STOP or len(pending) >= self.ss.mail["digest_count"] or now >= deadline):
+                try:
+                    self.MailSend(*self._digest(pending))
+                except Exception as e:
+                    self.ss.debugger.dump_exception("_run() exception")
+                pending = []
+
+            if item is STOP:
+                self._close()
+                return
+
+            if self.smtp and now - self.used > IDLE_TIMEOUT:
+                self._close()
+            if self.ss.mail["spool"] and now - self.retried > RETRY_INTERVAL:
+                self.retried = now
+                self._unspool()
+
+    # Combine notifications into one message.
+    def _digest(self, pending):
+        if len(pending) == 1:
+            subject, body_text, body_html, trailer = pending[0]
+        else:
+            subject = "%s (%d notifications)" % (pending[0][0], len(pending))
+            body_text = "\n".join(item[1] for item in pending)
+            body_html = "<hr />".join(item[2] for item in pending)
+            trailer = pending[-1][3]
+
+        if trailer:
+            body_text += "\n" + trailer[0]
+            body_html += "<hr />" + trailer[1]
+        body_html = "<html><title>" + subject + "</title><body>" + body_html + "</body></html>"
+        return subject, body_text, body_html
+
+    def _connect(self):
+        if self.ss.mail["mode"] == "ssl":
+            smtp = smtplib.SMTP_SSL(self.ss.mail["hostname"], self.ss.mail["port"], timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(self.ss.mail["hostname"], self.ss.mail["port"], timeout=SMTP_TIMEOUT)
+            if self.ss.mail["mode"] == "tls":
+                smtp.ehlo()
+                smtp.starttls()
+                smtp.ehlo()
+        if self.ss.mail["username"]:
+            smtp.login(self.ss.mail["username"], self.ss.mail["password"])
+        self.ss.debugger.debug("connected to smtp server %s:%d", (self.ss.mail["hostname"], self.ss.mail["port"]))
+        return smtp
+
+    def _close(self):
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+    # Send over the open connection. If the server has closed it, reconnect
+    # and try once more.
+    def _send(self, payload, mail_from, rcpt_to):
+        for attempt in range(2):
+            try:
+                if not self.smtp:
+                    self.smtp = self._connect()
+                refused = self.smtp.sendmail(mail_from, rcpt_to, payload)
+                self.used = time.time()
+                if refused:
+                    self.ss.debugger.warning("failed to send email, failed receipients: %s", (", ".join(refused.keys()),))
                 else:
-                    self.ss.debugger.debug("email sent: %s", (ret,))
+                    self.ss.debugger.debug("email sent")
+                return True
+            except smtplib.SMTPServerDisconnected:
+                self._close()
+            except (smtplib.SMTPException, socket.error) as e:
+                self.ss.debugger.error("failed to send email via %s:%d: %s", (self.ss.mail["hostname"], self.ss.mail["port"], e))
+                self._close()
+                return False
+        self.ss.debugger.error("failed to send email via %s:%d: disconnected", (self.ss.mail["hostname"], self.ss.mail["port"]))
+        return False
 
-        except Exception as e:
-            self.ss.debugger.dump_exception("MailSend() exception")
+    def _spool(self, payload):
+        path = os.path.join(self.ss.mail["spool"], "%.6f.eml" % time.time())
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(payload)
+            os.rename(path + ".tmp", path)
+            self.ss.debugger.info("spooled email to %s", (path,))
+        except (IOError, OSError) as e:
+            self.ss.debugger.error("failed to spool email to %s: %s", (path, e))
+
+    # Send spooled messages, oldest first, stopping at the first failure.
+    def _unspool(self):
+        try:
+            names = sorted(name for name in os.listdir(self.ss.mail["spool"]) if name.endswith(".eml"))
+        except OSError as e:
+            self.ss.debugger.error("failed to read email spool %s: %s", (self.ss.mail["spool"], e))
+            return
+
+        for name in names:
+            path = os.path.join(self.ss.mail["spool"], name)
+            try:
+                with open(path) as f:
+                    payload = f.read()
+            except (IOError, OSError, ValueError) as e:
+                self.ss.debugger.error("failed to read spooled email %s: %s", (path, e))
+                self._set_aside(path)
+                continue
+            if not self._send(payload, _address(self.ss.mail["from"]), [_address(to) for to in self.ss.mail["to"]]):
+                return
+            try:
+                os.remove(path)
+            except OSError as e:
+                self.ss.debugger.error("failed to remove sent email %s: %s", (path, e))
+                # Don't send it again.
+                self._set_aside(path)
+                continue
+            self.ss.debugger.info("sent spooled email %s", (path,))
+
+    # Move a spooled message out of the way, so it isn't tried again.
+    def _set_aside(self, path):
+        try:
+            os.rename(path, path + ".failed")
+            self.ss.debugger.warning("moved %s aside to %s.failed", (path, path))
+        except OSError as e:
+            self.ss.debugger.error("failed to move %s aside: %s", (path, e))
+
+# Configured addresses are either an address, or a (name, address) pair.
+def _address(address):
+    if isinstance(address, tuple):
+        return address[1]
+    return address
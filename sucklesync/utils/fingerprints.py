@@ -0,0 +1,75 @@
+import hashlib
+import os
+import sqlite3
+import stat
+import threading
+
+# Buffer size for hashing files.
+CHUNK = 1024 * 1024
+
+# An index of the content fingerprints (size, modification time and, if
+# enabled, SHA-1) of the files under the destinations, so a remote file that is
+# already stored locally, under another sucklepath or another name, can be
+# found by its fingerprint. Kept in an SQLite database, shared by the transfer
+# threads and the thread indexing the destinations at start.
+class Index:
+    def __init__(self, filename, hashes = False):
+        self.hashes = hashes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fingerprint ON files (size, mtime)")
+        self.connection.commit()
+
+    # Index every file under a local directory, only (re)hashing files that
+    # changed since they were last indexed, and forget those that are gone.
+    # Subdirectories named in exclude are skipped. Returns the number of files
+    # indexed.
+    def add_tree(self, root, exclude = ()):
+        root = root.rstrip("/")
+        with self.lock:
+            known = dict((path, (size, mtime, digest)) for path, size, mtime, digest in self.connection.execute("SELECT path, size, mtime, hash FROM files WHERE path >= ? AND path < ?", (root + "/", root + "0")))
+
+        rows = []
+        seen = set()
+        for directory, directories, files in os.walk(root):
+            directories[:] = [name for name in directories if name not in exclude]
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    status = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(status.st_mode):
+                    continue
+                seen.add(path)
+                size, mtime = status.st_size, int(status.st_mtime)
+                previous = known.get(path)
+                if previous and previous[:2] == (size, mtime) and (previous[2] or not self.hashes):
+                    continue
+                digest = None
+                if self.hashes:
+                    try:
+                        digest = hash_file(path)
+                    except (IOError, OSError):
+                        continue
+                rows.append((path, size, mtime, digest))
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime, hash) VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known if path not in seen])
+            self.connection.commit()
+        return len(seen)
+
+    # The local files with a fingerprint, as a list of (path, hash).
+    def lookup(self, size, mtime):
+        with self.lock:
+            return self.connection.execute("SELECT path, hash FROM files WHERE size = ? AND mtime = ?", (size, int(mtime))).fetchall()
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,62 @@
+import json
+import os
+import time
+
+from sucklesync.utils import scan
+
+# Keeps the transfer queue, and the directories being transferred, in a JSON
+# file so they survive a restart or crash. Sucklepaths are identified by their
+# source and destination rather than by their number, so entries still find
+# their sucklepath if the configuration is reordered. The file is replaced
+# atomically, so it's never left half written. Paths are written as latin-1
+# text, so any bytes survive the trip, whatever their encoding.
+class Journal:
+    def __init__(self, filename, interval = 10):
+        self.filename = filename
+        self.interval = interval
+        self.written = 0
+
+    # Returns (queued, in_flight), each a list of (source, destination,
+    # directory, summary), or None if there is no usable journal.
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+            # Journals written before paths were kept as latin-1 hold UTF-8.
+            encoding = state.get("encoding", "utf-8")
+            return [_entry(entry, encoding) for entry in state["queue"]], [_entry(entry, encoding) for entry in state["in_flight"]]
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    # Write the journal, unless it was written less than interval seconds ago
+    # and force isn't set. Entries are (source, destination, directory,
+    # summary). Returns True if the journal was written.
+    def save(self, queued, in_flight, force = False):
+        now = time.time()
+        if not force and now - self.written < self.interval:
+            return False
+
+        state = {
+            "saved": now,
+            "encoding": "latin-1",
+            "queue": [_record(*entry) for entry in queued],
+            "in_flight": [_record(*entry) for entry in in_flight],
+        }
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.filename + ".tmp", self.filename)
+        self.written = now
+        return True
+
+def _record(source, destination, directory, summary):
+    return {"source": source.decode("latin-1"), "destination": destination.decode("latin-1"), "directory": directory.decode("latin-1"), "mtime": summary.mtime, "size": summary.size, "files": summary.files}
+
+def _entry(record, encoding):
+    summary = scan.Summary()
+    summary.mtime = float(record["mtime"])
+    summary.size = int(record["size"])
+    summary.files = int(record["files"])
+    # Paths are byte strings everywhere else.
+    return record["source"].encode(encoding), record["destination"].encode(encoding), record["directory"].encode(encoding), summary
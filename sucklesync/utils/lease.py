@@ -0,0 +1,175 @@
+import errno
+import hashlib
+import json
+import os
+import time
+
+# Lets several sucklesync daemons, on one machine or on several sharing a
+# filesystem, split the sucklepaths between them. Each sucklepath has a lease
+# file in a shared directory, naming the daemon (instance) that syncs it and
+# when the lease expires. The holder renews its leases well before they
+# expire; a lease that has expired, because its holder died or lost access to
+# the directory, can be taken over by any instance.
+#
+# Every change to a lease is made while holding its lock file, created with
+# O_EXCL, and lease files are replaced atomically with a rename, so instances
+# never see each other's leases half written. A lock left behind by a crash
+# is broken once it's older than a lease. Expiry times are compared against
+# the local clock, so keep the servers' clocks synchronized.
+#
+# Every instance also keeps a heartbeat file in the instances subdirectory,
+# so each can work out its fair share of the sucklepaths.
+class Leases:
+    def __init__(self, directory, instance, duration = 60):
+        self.directory = directory
+        self.instance = instance
+        self.duration = duration
+        # The names of the leases held, with when each expires.
+        self.held = {}
+        # When the leases are next due to be renewed.
+        self.renewal = 0
+
+        self.instances = os.path.join(directory, "instances")
+        if not os.path.isdir(self.instances):
+            try:
+                os.makedirs(self.instances)
+            except OSError as e:
+                # Another instance may have just created it.
+                if e.errno != errno.EEXIST:
+                    raise
+
+    # The name of a sucklepath's lease, the same for every instance.
+    def name(self, *identity):
+        return hashlib.sha1("\0".join(identity)).hexdigest()[:20]
+
+    def _path(self, name, suffix = ".lease"):
+        return os.path.join(self.directory, name + suffix)
+
+    # Announce that this instance is alive until a lease from now would
+    # expire, and return how many instances are alive (including this one).
+    def heartbeat(self, now = None):
+        if now is None:
+            now = time.time()
+
+        _write(os.path.join(self.instances, self.instance), {"instance": self.instance, "expires": now + self.duration}, self.instance)
+        alive = 1
+        for instance in os.listdir(self.instances):
+            if instance == self.instance or instance.endswith(".tmp"):
+                continue
+            path = os.path.join(self.instances, instance)
+            record = _read(path)
+            if record and record.get("expires", 0) > now:
+                alive += 1
+            elif record is not None:
+                # Long gone, it writes a new heartbeat if it comes back.
+                _remove(path)
+        return alive
+
+    # Take a lease that is free, expired or already held, renewing it.
+    # description is written into the lease for people looking at the
+    # directory. Returns True if this instance now holds the lease, False if
+    # another one does (or the lease is busy being changed).
+    def claim(self, name, description = None, now = None):
+        if now is None:
+            now = time.time()
+
+        if not self._lock(name, now):
+            return False
+        try:
+            record = _read(self._path(name))
+            if record and record.get("instance") != self.instance and record.get("expires", 0) > now:
+                self.held.pop(name, None)
+                return False
+            expires = now + self.duration
+            _write(self._path(name), {"instance": self.instance, "expires": expires, "sucklepath": description}, self.instance)
+            self.held[name] = expires
+            return True
+        finally:
+            self._unlock(name)
+
+    # Renew a held lease. Returns False if it was taken over by another
+    # instance in the meantime, and is no longer held.
+    def renew(self, name, description = None, now = None):
+        if now is None:
+            now = time.time()
+
+        if self.claim(name, description, now):
+            return True
+        if name in self.held and self.held[name] > now:
+            # Someone else is changing the lock right now, the lease is ours
+            # until it expires. Try again on the next renewal.
+            record = _read(self._path(name))
+            if record is None or record.get("instance") == self.instance:
+                return True
+        self.held.pop(name, None)
+        return False
+
+    # Give up a lease so another instance can take it right away.
+    def release(self, name, now = None):
+        if now is None:
+            now = time.time()
+
+        self.held.pop(name, None)
+        if not self._lock(name, now):
+            # It expires on its own.
+            return
+        try:
+            record = _read(self._path(name))
+            if record and record.get("instance") == self.instance:
+                _remove(self._path(name))
+        finally:
+            self._unlock(name)
+
+    # Release every lease and stop announcing this instance.
+    def release_all(self):
+        for name in list(self.held):
+            self.release(name)
+        _remove(os.path.join(self.instances, self.instance))
+
+    # Create a lease's lock file, breaking it if it was left behind. Returns
+    # False if another instance holds it.
+    def _lock(self, name, now):
+        path = self._path(name, ".lock")
+        for attempt in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644))
+                return True
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if now - os.stat(path).st_mtime < self.duration:
+                    return False
+                # Renamed first, so only one instance breaks it.
+                stale = path + "." + self.instance + ".stale"
+                os.rename(path, stale)
+                _remove(stale)
+            except OSError:
+                pass
+        return False
+
+    def _unlock(self, name):
+        _remove(self._path(name, ".lock"))
+
+# Returns the JSON record in a file, {} if it can't be parsed, or None if
+# there is no such file.
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        return {}
+
+def _write(path, record, instance):
+    temporary = "%s.%s.tmp" % (path, instance)
+    with open(temporary, "w") as f:
+        json.dump(record, f)
+    os.rename(temporary, path)
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
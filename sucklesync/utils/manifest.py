@@ -0,0 +1,41 @@
+import sqlite3
+import threading
+
+# Remembers the signature (latest mtime, total size, file count) of every
+# top-level directory as of its last successful sync, so directories that
+# haven't changed since don't need to be handed to rsync again. Signatures are
+# kept in memory and written through to an SQLite database, so they survive
+# restarts. Cleanups forget directories from their own threads.
+class Manifest:
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        # Paths are byte strings, not necessarily ASCII.
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS manifest (source TEXT, destination TEXT, directory TEXT, mtime REAL, size INTEGER, files INTEGER, PRIMARY KEY (source, destination, directory))")
+        self.connection.commit()
+
+        self.signatures = {}
+        for source, destination, directory, mtime, size, files in self.connection.execute("SELECT source, destination, directory, mtime, size, files FROM manifest"):
+            self.signatures[(source, destination, directory)] = (mtime, size, files)
+
+    # Returns True if the directory was last synced with this signature.
+    def unchanged(self, source, destination, directory, signature):
+        return self.signatures.get((source, destination, directory)) == signature
+
+    def set(self, source, destination, directory, signature):
+        if self.signatures.get((source, destination, directory)) == signature:
+            return
+        mtime, size, files = signature
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO manifest (source, destination, directory, mtime, size, files) VALUES (?, ?, ?, ?, ?, ?)", (source, destination, directory, mtime, size, files))
+            self.connection.commit()
+            self.signatures[(source, destination, directory)] = signature
+
+    def forget(self, source, destination, directory):
+        if (source, destination, directory) not in self.signatures:
+            return
+        with self.lock:
+            self.connection.execute("DELETE FROM manifest WHERE source = ? AND destination = ? AND directory = ?", (source, destination, directory))
+            self.connection.commit()
+            self.signatures.pop((source, destination, directory), None)
@@ -0,0 +1,163 @@
+import BaseHTTPServer
+import json
+import threading
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# The metrics kept by a running daemon. They're safe to update from any thread,
+# and can be rendered in the Prometheus text format or as JSON.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def counter(self, name, help, labels = ()):
+        return self._register(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels = ()):
+        return self._register(Gauge(self, name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def prometheus(self):
+        with self.lock:
+            lines = []
+            for metric in self.metrics:
+                lines.append("# HELP %s %s" % (metric.name, metric.help))
+                lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+                lines.extend(metric.prometheus())
+            return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        with self.lock:
+            return dict((metric.name, {"type": metric.kind, "help": metric.help, "values": metric.as_list()}) for metric in self.metrics)
+
+    def json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+class Metric:
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _labels(self, key, extra = None):
+        pairs = zip(self.labels, key)
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (label, _escape(value)) for label, value in pairs) + "}"
+
+    def prometheus(self):
+        return ["%s%s %s" % (self.name, self._labels(key), _number(value)) for key, value in sorted(self.values.iteritems())]
+
+    def as_list(self):
+        return [{"labels": dict(zip(self.labels, key)), "value": value} for key, value in sorted(self.values.iteritems())]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels, buckets):
+        Metric.__init__(self, registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            observed = self.values.get(key)
+            if observed is None:
+                observed = self.values[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    observed["buckets"][index] += 1
+            observed["count"] += 1
+            observed["sum"] += value
+
+    def prometheus(self):
+        lines = []
+        for key, observed in sorted(self.values.iteritems()):
+            for bucket, count in zip(self.buckets, observed["buckets"]):
+                lines.append("%s_bucket%s %d" % (self.name, self._labels(key, ("le", _number(bucket))), count))
+            lines.append("%s_bucket%s %d" % (self.name, self._labels(key, ("le", "+Inf")), observed["count"]))
+            lines.append("%s_sum%s %s" % (self.name, self._labels(key), _number(observed["sum"])))
+            lines.append("%s_count%s %d" % (self.name, self._labels(key), observed["count"]))
+        return lines
+
+    def as_list(self):
+        values = []
+        for key, observed in sorted(self.values.iteritems()):
+            buckets = dict((_number(bucket), count) for bucket, count in zip(self.buckets, observed["buckets"]))
+            values.append({"labels": dict(zip(self.labels, key)), "count": observed["count"], "sum": observed["sum"], "buckets": buckets})
+        return values
+
+# Serve the registry over HTTP from a background thread: /metrics in the
+# Prometheus text format, /metrics.json as JSON.
+class Exporter:
+    def __init__(self, registry, address, port):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = registry.prometheus()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = registry.json()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _number(value):
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
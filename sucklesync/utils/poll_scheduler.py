@@ -0,0 +1,121 @@
+import heapq
+import random
+import time
+
+# Decides when each sucklepath is next polled. Every path has its own delay:
+# activity resets it to the path's minimum, each idle poll doubles it up to the
+# path's maximum. Delays are randomly stretched or shrunk by up to jitter (a
+# fraction) so paths don't end up polled in lockstep.
+#
+# Due times live in a heap; rescheduling a path leaves its old entry in place,
+# it's skipped as stale when it reaches the top.
+class PollScheduler:
+    def __init__(self, jitter = 0.1):
+        self.jitter = jitter
+        self.heap = []
+        self.due = {}
+        self.delays = {}
+        self.limits = {}
+
+    def __contains__(self, key):
+        return key in self.due
+
+    # Start scheduling a path, polling it right away.
+    def add(self, key, minimum, maximum, now = None):
+        self.limits[key] = (minimum, max(minimum, maximum))
+        self.delays[key] = 0
+        self._schedule(key, time.time() if now is None else now)
+
+    def remove(self, key):
+        self.due.pop(key, None)
+        self.delays.pop(key, None)
+        self.limits.pop(key, None)
+
+    # Give the paths new keys: mapping[key] is a path's new key, or None to
+    # stop scheduling it. Due times and delays are kept.
+    def remap(self, mapping):
+        due = {}
+        delays = {}
+        limits = {}
+        for key, renamed in mapping.iteritems():
+            if renamed is None or key not in self.limits:
+                continue
+            if key in self.due:
+                due[renamed] = self.due[key]
+            delays[renamed] = self.delays[key]
+            limits[renamed] = self.limits[key]
+        self.due = due
+        self.delays = delays
+        self.limits = limits
+        self.heap = [(when, key) for key, when in due.iteritems()]
+        heapq.heapify(self.heap)
+
+    # Change a path's delays. Its current delay is brought within them, and
+    # a path due later than the new maximum is brought forward.
+    def tune(self, key, minimum, maximum, now = None):
+        if key not in self.limits:
+            return
+        if now is None:
+            now = time.time()
+
+        maximum = max(minimum, maximum)
+        self.limits[key] = (minimum, maximum)
+        if self.delays[key]:
+            self.delays[key] = min(maximum, max(minimum, self.delays[key]))
+        if key in self.due and self.due[key] > now + maximum:
+            self._schedule(key, now + maximum)
+
+    # When the next path is due, or None if nothing is scheduled.
+    def next_due(self):
+        while self.heap:
+            due, key = self.heap[0]
+            if self.due.get(key) == due:
+                return due
+            heapq.heappop(self.heap)
+        return None
+
+    # Remove and return the paths that are due, most overdue first.
+    def pop_due(self, now = None):
+        if now is None:
+            now = time.time()
+
+        keys = []
+        while self.heap and self.heap[0][0] <= now:
+            due, key = heapq.heappop(self.heap)
+            if self.due.get(key) == due:
+                del self.due[key]
+                keys.append(key)
+        return keys
+
+    # Schedule the next poll of a path that was just polled.
+    def reschedule(self, key, active, now = None):
+        if key not in self.limits:
+            return
+
+        minimum, maximum = self.limits[key]
+        if active:
+            delay = minimum
+        else:
+            delay = min(maximum, max(minimum, self.delays[key] * 2))
+        self.delays[key] = delay
+
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        due = (time.time() if now is None else now) + delay
+        if self.due.get(key, due) < due:
+            # A poll was asked for while it was being polled.
+            return
+        self._schedule(key, due)
+
+    # When a path is next due, or None if it isn't scheduled (or is being
+    # polled).
+    def when(self, key):
+        return self.due.get(key)
+
+    # Poll a path as soon as possible.
+    def poll_now(self, key, now = None):
+        if key in self.limits:
+            self._schedule(key, time.time() if now is None else now)
+
+    def _schedule(self, key, due):
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, key))
@@ -0,0 +1,52 @@
+import Queue
+import threading
+
+# A fixed number of worker threads running jobs in the background. Jobs are
+# submitted and their results collected from a single dispatching thread, in
+# the order the jobs finish.
+#
+# Several pools can share one results queue, so the dispatcher can wait on all
+# of them at once. It calls done() on the pool a job belonged to once it has
+# its result.
+class Pool:
+    def __init__(self, workers, results = None, name = "worker"):
+        self.workers = 0
+        self.threads = 0
+        self.name = name
+        self.running = 0
+        self.jobs = Queue.Queue()
+        self.results = results or Queue.Queue()
+        self.resize(workers)
+
+    # Change how many jobs run at once. Threads are started as needed, but
+    # never stopped: when shrinking, fewer jobs are submitted at once and the
+    # surplus threads stay idle.
+    def resize(self, workers):
+        self.workers = max(1, workers)
+        while self.threads < self.workers:
+            thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, self.threads))
+            thread.daemon = True
+            thread.start()
+            self.threads += 1
+
+    # Returns True if there's an idle worker to start another job.
+    def available(self):
+        return self.running < self.workers
+
+    def submit(self, job, function, *args):
+        self.running += 1
+        self.jobs.put((job, function, args))
+
+    # Record that one of this pool's jobs has finished.
+    def done(self):
+        self.running -= 1
+
+    def _work(self):
+        while True:
+            job, function, args = self.jobs.get()
+            try:
+                result = function(*args)
+            except Exception:
+                # Jobs log their own failures, just keep the worker alive.
+                result = None
+            self.results.put((job, result))
@@ -0,0 +1,148 @@
+import collections
+import os
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+# rsync separates progress updates with carriage returns, everything else uses
+# newlines: treat either as the end of a line.
+LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+READ_SIZE = 65536
+STDERR_LINES = 20
+
+# Number of processes started so far, by program name.
+spawned = collections.Counter()
+_spawned_lock = threading.Lock()
+
+def count(argv):
+    with _spawned_lock:
+        spawned[os.path.basename(argv[0])] += 1
+
+# Streams, or anything else with a cancel() method, with a command running.
+running = set()
+_running_lock = threading.Lock()
+
+def track(command):
+    with _running_lock:
+        running.add(command)
+
+def untrack(command):
+    with _running_lock:
+        running.discard(command)
+
+# Kill every command still running, e.g. when shutting down.
+def cancel_all():
+    with _running_lock:
+        streams = list(running)
+    for stream in streams:
+        stream.cancel()
+
+# Stream the output of a command one line at a time. Unlike EasyProcess, output
+# is never held in memory: lines are yielded as soon as they're read. Mirrors
+# the EasyProcess attributes (return_code, timeout_happened, oserror, stderr) so
+# callers can report failures the same way once the stream is exhausted.
+#
+# timeout: kill the command if it produces no output for this many seconds.
+# limit: kill the command if it runs for longer than this many seconds.
+class Stream:
+    def __init__(self, command, timeout = None, limit = None):
+        self.command = command
+        self.timeout = timeout
+        self.limit = limit
+        self.process = None
+        self.return_code = None
+        self.timeout_happened = False
+        self.limit_happened = False
+        self.cancelled = False
+        self.oserror = None
+        self.stderr = ""
+        self._stderr = collections.deque(maxlen=STDERR_LINES)
+        self._started = None
+        self._last_output = None
+        self._finished = threading.Event()
+
+    def __iter__(self):
+        return self.lines()
+
+    def lines(self):
+        argv = shlex.split(self.command)
+        try:
+            # In its own process group, so kill() also reaches anything it starts.
+            self.process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        except OSError as e:
+            self.oserror = e
+            self.return_code = -1
+            return
+        count(argv)
+        track(self)
+        if self.cancelled:
+            # Cancelled while it was starting.
+            self.kill()
+
+        self._started = self._last_output = time.time()
+        stderr = threading.Thread(target=self._read_stderr)
+        stderr.daemon = True
+        stderr.start()
+        if self.timeout or self.limit:
+            watchdog = threading.Thread(target=self._watchdog)
+            watchdog.daemon = True
+            watchdog.start()
+
+        fd = self.process.stdout.fileno()
+        partial = ""
+        complete = False
+        try:
+            while True:
+                chunk = os.read(fd, READ_SIZE)
+                if not chunk:
+                    break
+                self._last_output = time.time()
+                pieces = LINE_BREAK.split(partial + chunk)
+                partial = pieces.pop()
+                for line in pieces:
+                    yield line
+            if partial:
+                yield partial
+            complete = True
+        finally:
+            # The caller stopped reading early, don't leave the command running.
+            if not complete and self.process.poll() is None:
+                self.kill()
+            self.return_code = self.process.wait()
+            self._finished.set()
+            untrack(self)
+            stderr.join(1)
+            self.stderr = "\n".join(self._stderr)
+
+    # Kill the command from another thread, e.g. to give up on it.
+    def cancel(self):
+        self.cancelled = True
+        self.kill()
+
+    def kill(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _read_stderr(self):
+        for line in iter(self.process.stderr.readline, ""):
+            self._stderr.append(line.rstrip("\n"))
+
+    def _watchdog(self):
+        while not self._finished.wait(1):
+            now = time.time()
+            if self.timeout and now - self._last_output > self.timeout:
+                self.timeout_happened = True
+                self.kill()
+                return
+            if self.limit and now - self._started > self.limit:
+                self.limit_happened = True
+                self.kill()
+                return
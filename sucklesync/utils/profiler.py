@@ -0,0 +1,153 @@
+import contextlib
+import heapq
+import json
+import os
+import resource
+import threading
+import time
+
+from sucklesync.utils import process
+
+# Order phases are reported in; any others follow alphabetically.
+PHASES = ("scan", "classify", "dispatch", "wait", "email", "cleanup")
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+# Breaks each poll cycle down by phase, recording the wall-clock time spent in
+# every phase, the time taken by each transfer, the processes started, peak
+# memory use, and the CPU time of the cycle as a whole (of sucklesync itself,
+# and of the processes it waited for). Phases may repeat within a cycle, and
+# run at the same time in the pools' threads: a phase's time is how long at
+# least one of them was running, so overlapping runs are only counted once.
+# CPU time is only measured for the cycle, os.times() can't tell the threads
+# apart.
+#
+# Optionally, every cycle is also run under cProfile, keeping the stats of the
+# slowest count cycles in directory. cProfile only sees the thread that started
+# the cycle, not the pools' threads.
+class Profiler:
+    def __init__(self, directory = None, count = 5):
+        self.directory = directory
+        self.count = count
+        self.slowest = []
+        self.lock = threading.Lock()
+        self.record = None
+        self.last = None
+        self._started = None
+        self._profile = None
+        # Phase name: [runs in progress, when the current span was last counted].
+        self._active = {}
+
+    def start(self):
+        cpu, children = _cpu()
+        self._started = (time.time(), cpu, children, dict(process.spawned))
+        with self.lock:
+            self.record = {"started": self._started[0], "phases": {}, "transfers": []}
+            # Runs still in progress from the last cycle are counted from now.
+            for active in self._active.itervalues():
+                active[1] = self._started[0]
+        if self.directory:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self.lock:
+            active = self._active.setdefault(name, [0, None])
+            if not active[0]:
+                active[1] = time.time()
+            active[0] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                active[0] -= 1
+                if self.record is not None:
+                    phase = self._phase(name)
+                    phase["count"] += 1
+                    if not active[0]:
+                        phase["seconds"] += time.time() - active[1]
+
+    def _phase(self, name):
+        return self.record["phases"].setdefault(name, {"seconds": 0.0, "count": 0})
+
+    # Transfers run concurrently, in the pool's threads, so they're timed one by
+    # one rather than as a phase.
+    def transfer(self, source, directory, seconds, return_code):
+        if self.record is None:
+            return
+        with self.lock:
+            self.record["transfers"].append({"source": source, "directory": directory, "seconds": seconds, "return_code": return_code})
+
+    # End the cycle, returning its record.
+    def finish(self):
+        if self.record is None:
+            return None
+
+        if self._profile:
+            self._profile.disable()
+
+        started, cpu, children, spawned = self._started
+        ended_cpu, ended_children = _cpu()
+        ended = time.time()
+        with self.lock:
+            record = self.record
+            # Count the time of runs still in progress up to now.
+            for name, active in self._active.iteritems():
+                if active[0]:
+                    self._phase(name)["seconds"] += ended - active[1]
+            self.record = None
+        record["seconds"] = ended - started
+        record["cpu_seconds"] = ended_cpu - cpu
+        record["children_cpu_seconds"] = ended_children - children
+        record["processes"] = dict((name, count - spawned.get(name, 0)) for name, count in process.spawned.items() if count != spawned.get(name, 0))
+        record["peak_rss_kilobytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record["children_peak_rss_kilobytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        if self._profile:
+            self._keep(record)
+            self._profile = None
+
+        self.last = record
+        return record
+
+    # Dump the cycle's stats if it's among the slowest so far, removing the
+    # stats of the cycle it displaces.
+    def _keep(self, record):
+        if len(self.slowest) >= self.count and record["seconds"] <= self.slowest[0][0]:
+            return
+
+        path = os.path.join(self.directory, "cycle-%d-%.3fs.prof" % (record["started"], record["seconds"]))
+        self._profile.dump_stats(path)
+        record["profile"] = path
+        heapq.heappush(self.slowest, (record["seconds"], path))
+        while len(self.slowest) > self.count:
+            seconds, removed = heapq.heappop(self.slowest)
+            try:
+                os.remove(removed)
+            except OSError:
+                pass
+
+# One line summary of a cycle record, for the log.
+def summarize(record):
+    names = [name for name in PHASES if name in record["phases"]]
+    names += sorted(name for name in record["phases"] if name not in PHASES)
+    parts = []
+    for name in names:
+        phase = record["phases"][name]
+        parts.append("%s %.2fs" % (name, phase["seconds"]))
+    parts.append("cpu %.2fs" % (record["cpu_seconds"] + record["children_cpu_seconds"]))
+    if record["transfers"]:
+        parts.append("%d transfer(s), slowest %.2fs" % (len(record["transfers"]), max(transfer["seconds"] for transfer in record["transfers"])))
+    processes = ", ".join("%s=%d" % (name, count) for name, count in sorted(record["processes"].iteritems()))
+    parts.append("processes: %s" % (processes or "none"))
+    parts.append("peak rss %dKB" % record["peak_rss_kilobytes"])
+    return "; ".join(parts)
+
+# Append a cycle record to a file, one JSON object per line.
+def append(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
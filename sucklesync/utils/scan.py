@@ -0,0 +1,75 @@
+import collections
+
+# Format passed to the remote find's -printf: type, mtime, size, path.
+PRINTF_FORMAT = "%y %T@ %s %p\\n"
+# Run before find, so the scan knows the remote server's clock.
+CLOCK_COMMAND = "date +%s; "
+
+# What is known about one top-level entry of a sucklepath.
+class Summary:
+    def __init__(self):
+        self.mtime = 0.0
+        self.size = 0
+        self.files = 0
+        # Whether the directory holds the marker file, or the lock file, that
+        # say an upload into it is finished, or still in progress.
+        self.marker = False
+        self.locked = False
+
+    def signature(self):
+        return (self.mtime, self.size, self.files)
+
+# Aggregates the streamed output of a remote find into one Summary per
+# top-level entry of the source, so memory is bounded by the number of
+# top-level entries rather than by the number of files. A partial scan only
+# walks the listed directories. marker and lock are the names of the files
+# that flag a directory as finished or still being uploaded.
+class Scan:
+    def __init__(self, source, directories = None, marker = None, lock = None):
+        self.source = source
+        self.directories = directories
+        self.marker = marker
+        self.lock = lock
+        self.prefix = source.rstrip("/") + "/"
+        self.summaries = collections.OrderedDict()
+        self.entries = 0
+        # Bytes of scan output received from the remote server.
+        self.received = 0
+        # Set once the whole source has been listed without errors.
+        self.complete = False
+        # The remote server's clock when the scan started, if it's known.
+        self.now = None
+
+    def add(self, line):
+        self.received += len(line) + 1
+        try:
+            kind, mtime, size, path = line.split(" ", 3)
+            mtime = float(mtime)
+        except ValueError:
+            # The output of CLOCK_COMMAND, before any entry.
+            if not self.entries and self.now is None and line.isdigit():
+                self.now = float(line)
+            return
+        self.entries += 1
+
+        if not path.startswith(self.prefix):
+            # The source directory itself.
+            return
+        relative = path[len(self.prefix):].split("/", 1)
+        directory = relative[0]
+        if not directory or directory[0] == ".":
+            return
+
+        summary = self.summaries.get(directory)
+        if summary is None:
+            summary = self.summaries[directory] = Summary()
+        if len(relative) > 1:
+            if relative[1] == self.marker:
+                summary.marker = True
+            elif relative[1] == self.lock:
+                summary.locked = True
+        if mtime > summary.mtime:
+            summary.mtime = mtime
+        if kind == "f":
+            summary.size += int(size)
+            summary.files += 1
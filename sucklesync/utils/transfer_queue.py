@@ -0,0 +1,168 @@
+import heapq
+import itertools
+import time
+
+# Transfer ordering policies.
+FIFO     = "fifo"
+OLDEST   = "oldest"
+SMALLEST = "smallest"
+NEWEST   = "newest"
+POLICIES = (FIFO, OLDEST, SMALLEST, NEWEST)
+
+REMOVED = object()
+
+# The directories waiting to be transferred, ordered by policy:
+#  fifo:     in the order they were first queued
+#  oldest:   the directory that has been ready longest first
+#  smallest: the directory with the fewest bytes first
+#  newest:   the most recently completed directory first
+# A sucklepath's weight makes its directories look that many times older,
+# smaller, newer or earlier than they are. Ages are measured from a fixed
+# reference time, by default when the queue was created, so directories
+# queued by scans at different times are ranked on the same baseline.
+#
+# Entries live in a heap, with a dict for membership tests. Pushing a directory
+# that is already queued re-prioritizes it in place: the old heap entry is
+# marked removed and skipped when it reaches the top. Promoted items stay at
+# the front of the queue, the most recently promoted first, whatever the
+# policy says.
+class TransferQueue:
+    def __init__(self, policy = FIFO, reference = None):
+        self.policy = policy
+        self.reference = time.time() if reference is None else reference
+        self.heap = []
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.promoted = {}
+        self.promotions = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    # Iterate over the queued items, in no particular order.
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def _priority(self, summary, weight, sequence):
+        if self.policy == OLDEST:
+            return -_older(self.reference - summary.mtime, weight)
+        elif self.policy == SMALLEST:
+            return summary.size / float(weight)
+        elif self.policy == NEWEST:
+            return -_older(summary.mtime - self.reference, weight)
+        else:
+            return sequence / float(weight)
+
+    # Queue an item (or re-prioritize it if it's already queued) using the
+    # summary from the latest scan.
+    def push(self, item, summary, weight = 1):
+        entry = self.entries.get(item)
+        if entry and item in self.promoted:
+            entry[3] = summary
+            return
+        if entry:
+            sequence = entry[1]
+            priority = self._priority(summary, weight, sequence)
+            if priority == entry[0]:
+                entry[3] = summary
+                return
+            entry[2] = REMOVED
+        else:
+            sequence = next(self.sequence)
+            priority = self._priority(summary, weight, sequence)
+
+        entry = [priority, sequence, item, summary]
+        self.entries[item] = entry
+        heapq.heappush(self.heap, entry)
+
+    # Give queued items new names: function(item) returns an item's new name,
+    # or None to drop it. Priorities are kept.
+    def remap(self, function):
+        entries = {}
+        for item, entry in self.entries.iteritems():
+            renamed = function(item)
+            if renamed is None:
+                entry[2] = REMOVED
+            else:
+                entry[2] = renamed
+                entries[renamed] = entry
+        self.entries = entries
+        self.promoted = dict((function(item), promotion) for item, promotion in self.promoted.iteritems() if function(item) is not None)
+
+    # Order the queue by a (possibly new) policy, with weight(item) returning
+    # an item's weight. Items keep their place in fifo order.
+    def reprioritize(self, policy, weight):
+        self.policy = policy
+        self.heap = []
+        for item, entry in self.entries.iteritems():
+            if item not in self.promoted:
+                entry[0] = self._priority(entry[3], weight(item), entry[1])
+            self.heap.append(entry)
+        # Promoted items go back in front, in the same order.
+        for item in sorted(self.promoted, key=self.promoted.get):
+            entry = self.entries[item]
+            entry[0] = self._front(item) - 1
+        heapq.heapify(self.heap)
+
+    # Move a queued item to the front of the queue. Returns False if it isn't
+    # queued.
+    def promote(self, item):
+        entry = self.entries.get(item)
+        if not entry:
+            return False
+        entry[2] = REMOVED
+        entry = [self._front(item) - 1, entry[1], item, entry[3]]
+        self.entries[item] = entry
+        self.promoted[item] = next(self.promotions)
+        heapq.heappush(self.heap, entry)
+        return True
+
+    # The priority of the first item in the queue, other than item.
+    def _front(self, item):
+        priorities = [entry[0] for other, entry in self.entries.iteritems() if other != item]
+        return min(priorities) if priorities else 0
+
+    def discard(self, item):
+        entry = self.entries.pop(item, None)
+        if entry:
+            entry[2] = REMOVED
+            self.promoted.pop(item, None)
+
+    # Remove and return the highest priority (item, summary), or None if the
+    # queue is empty. Given accept, the highest priority item for which
+    # accept(item) is True is returned instead, or None if there is none; the
+    # items passed over keep their place.
+    def pop(self, accept = None):
+        skipped = []
+        found = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[2] is REMOVED:
+                continue
+            if accept is None or accept(entry[2]):
+                del self.entries[entry[2]]
+                self.promoted.pop(entry[2], None)
+                found = entry[2], entry[3]
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return found
+
+    # The next count items that will be popped, without removing them.
+    def upcoming(self, count):
+        return [entry[2] for entry in heapq.nsmallest(count, self.entries.itervalues())]
+
+    # The queued (item, summary) pairs, highest priority first.
+    def queued(self):
+        return [(entry[2], entry[3]) for entry in sorted(self.entries.itervalues())]
+
+# Scale an age (negative for times after the reference) to look weight times
+# older.
+def _older(age, weight):
+    if age >= 0:
+        return age * weight
+    return age / float(weight)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from sucklesync.utils import process
+
+# Follows a long-running command (normally inotifywait over ssh) that prints
+# the path of every file changed under a source, one per line, recording when
+# each top-level directory last changed. Directories that then go quiet can be
+# rescanned on their own, without walking the whole source.
+class Watcher:
+    def __init__(self, source, command):
+        self.source = source
+        self.prefix = source.rstrip("/") + "/"
+        self.command = command
+        self.changed = {}
+        self.lock = threading.Lock()
+        self.stream = None
+        self.thread = None
+
+    def start(self):
+        self.stream = process.Stream(self.command)
+        self.thread = threading.Thread(target=self._follow, name="watch-" + self.source)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        if self.stream and self.stream.process:
+            self.stream.kill()
+
+    # Mark a directory as changed now.
+    def touch(self, directory, now = None):
+        with self.lock:
+            self.changed[directory] = now or time.time()
+
+    # Directories that changed, but not within the past window seconds. They're
+    # forgotten until they change again.
+    def quiet(self, now, window):
+        with self.lock:
+            directories = [directory for directory, changed in self.changed.iteritems() if changed <= now - window]
+            for directory in directories:
+                del self.changed[directory]
+        return directories
+
+    def _follow(self):
+        for line in self.stream:
+            if not line.startswith(self.prefix):
+                continue
+            directory = line[len(self.prefix):].split("/", 1)[0]
+            if not directory or directory[0] == ".":
+                continue
+            self.touch(directory)
@@ -0,0 +1,84 @@
+import unittest
+
+from sucklesync.utils import poll_scheduler
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.polls = poll_scheduler.PollScheduler(0)
+
+    def test_add(self):
+        self.polls.add("a", 10, 40, 100)
+        self.polls.add("b", 10, 40, 90)
+        self.assertEqual(self.polls.next_due(), 90)
+        self.assertEqual(self.polls.pop_due(95), ["b"])
+        self.assertEqual(self.polls.pop_due(100), ["a"])
+        self.assertEqual(self.polls.next_due(), None)
+
+    # Activity polls again after the minimum delay, each idle poll doubles
+    # the delay up to the maximum.
+    def test_backoff(self):
+        self.polls.add("a", 10, 40, 0)
+        expected = [(False, 10), (False, 20), (False, 40), (False, 40), (True, 10), (False, 20)]
+        now = 0
+        for active, delay in expected:
+            self.assertEqual(self.polls.pop_due(now), ["a"])
+            self.polls.reschedule("a", active, now)
+            self.assertEqual(self.polls.when("a"), now + delay)
+            now += delay
+
+    def test_jitter(self):
+        polls = poll_scheduler.PollScheduler(0.5)
+        polls.add("a", 100, 100, 0)
+        polls.pop_due(0)
+        polls.reschedule("a", True, 0)
+        self.assertTrue(50 <= polls.when("a") <= 150)
+
+    def test_poll_now(self):
+        self.polls.add("a", 10, 40, 0)
+        self.polls.pop_due(0)
+        self.polls.reschedule("a", False, 0)
+        self.polls.poll_now("a", 5)
+        self.assertEqual(self.polls.pop_due(5), ["a"])
+
+        # Not scheduled, so not polled.
+        self.polls.poll_now("missing", 5)
+        self.assertEqual(self.polls.pop_due(5), [])
+
+    # A poll asked for while the path is being polled isn't overwritten by
+    # the reschedule that follows.
+    def test_poll_now_while_polling(self):
+        self.polls.add("a", 10, 40, 0)
+        self.polls.pop_due(0)
+        self.polls.poll_now("a", 5)
+        self.polls.reschedule("a", False, 6)
+        self.assertEqual(self.polls.when("a"), 5)
+
+    def test_remove(self):
+        self.polls.add("a", 10, 40, 0)
+        self.polls.remove("a")
+        self.assertFalse("a" in self.polls)
+        self.assertEqual(self.polls.pop_due(100), [])
+        self.polls.reschedule("a", True, 100)
+        self.assertEqual(self.polls.when("a"), None)
+
+    def test_remap(self):
+        self.polls.add(0, 10, 40, 50)
+        self.polls.add(1, 10, 40, 60)
+        self.polls.remap({0: None, 1: 0})
+        self.assertFalse(1 in self.polls)
+        self.assertEqual(self.polls.when(0), 60)
+        self.assertEqual(self.polls.pop_due(60), [0])
+
+    def test_tune(self):
+        self.polls.add("a", 10, 400, 0)
+        for now in (0, 10, 30, 70, 150):
+            self.polls.pop_due(now)
+            self.polls.reschedule("a", False, now)
+        self.assertEqual(self.polls.when("a"), 310)
+
+        # A lower maximum brings the next poll forward.
+        self.polls.tune("a", 10, 50, 200)
+        self.assertEqual(self.polls.when("a"), 250)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+
+from sucklesync.utils import scan
+from sucklesync.utils import transfer_queue
+
+def summary(mtime = 0.0, size = 0):
+    result = scan.Summary()
+    result.mtime = mtime
+    result.size = size
+    return result
+
+def order(queue):
+    return [item for item, summary in queue.queued()]
+
+class TransferQueueTest(unittest.TestCase):
+    def test_fifo(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.FIFO)
+        for item in ("a", "b", "c"):
+            queue.push(item, summary())
+        self.assertEqual(order(queue), ["a", "b", "c"])
+
+        # Pushing a queued item again keeps its place.
+        queue.push("a", summary(size=10))
+        self.assertEqual(order(queue), ["a", "b", "c"])
+
+    def test_smallest(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.SMALLEST)
+        queue.push("large", summary(size=300))
+        queue.push("small", summary(size=100))
+        queue.push("medium", summary(size=200))
+        self.assertEqual(order(queue), ["small", "medium", "large"])
+
+        # The latest scan re-prioritizes it.
+        queue.push("large", summary(size=50))
+        self.assertEqual(order(queue), ["large", "small", "medium"])
+
+    def test_oldest(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.OLDEST, reference=1000)
+        queue.push("newer", summary(mtime=900))
+        queue.push("older", summary(mtime=100))
+        queue.push("future", summary(mtime=2000))
+        self.assertEqual(order(queue), ["older", "newer", "future"])
+
+    def test_newest(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.NEWEST, reference=1000)
+        queue.push("older", summary(mtime=100))
+        queue.push("future", summary(mtime=2000))
+        queue.push("newer", summary(mtime=900))
+        self.assertEqual(order(queue), ["future", "newer", "older"])
+
+    # Directories queued by scans at different times are ranked on the same
+    # baseline, however long ago they were pushed.
+    def test_age_baseline(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.OLDEST, reference=1000)
+        queue.push("older", summary(mtime=-100))
+        queue.push("newer", summary(mtime=0))
+        self.assertEqual(order(queue), ["older", "newer"])
+
+        queue = transfer_queue.TransferQueue(transfer_queue.NEWEST, reference=1000)
+        queue.push("older", summary(mtime=1100))
+        queue.push("newer", summary(mtime=1200))
+        self.assertEqual(order(queue), ["newer", "older"])
+
+    def test_weights(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.SMALLEST)
+        queue.push("light", summary(size=100))
+        queue.push("heavy", summary(size=300), 4)
+        self.assertEqual(order(queue), ["heavy", "light"])
+
+        # Older than the reference, a weight makes a directory look older...
+        queue = transfer_queue.TransferQueue(transfer_queue.OLDEST, reference=1000)
+        queue.push("light", summary(mtime=700))
+        queue.push("heavy", summary(mtime=900), 4)
+        self.assertEqual(order(queue), ["heavy", "light"])
+
+        # ... and so does it after the reference.
+        queue = transfer_queue.TransferQueue(transfer_queue.OLDEST, reference=1000)
+        queue.push("light", summary(mtime=1100))
+        queue.push("heavy", summary(mtime=1300), 4)
+        self.assertEqual(order(queue), ["heavy", "light"])
+
+        queue = transfer_queue.TransferQueue(transfer_queue.NEWEST, reference=1000)
+        queue.push("light", summary(mtime=900))
+        queue.push("heavy", summary(mtime=700), 4)
+        self.assertEqual(order(queue), ["heavy", "light"])
+
+    def test_reprioritize(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.FIFO)
+        queue.push("large", summary(size=300))
+        queue.push("small", summary(size=100))
+        queue.reprioritize(transfer_queue.SMALLEST, lambda item: 1)
+        self.assertEqual(order(queue), ["small", "large"])
+        queue.reprioritize(transfer_queue.FIFO, lambda item: 1)
+        self.assertEqual(order(queue), ["large", "small"])
+
+    def test_promote(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.SMALLEST)
+        for item, size in (("a", 100), ("b", 200), ("c", 300)):
+            queue.push(item, summary(size=size))
+        self.assertTrue(queue.promote("c"))
+        self.assertTrue(queue.promote("b"))
+        self.assertFalse(queue.promote("missing"))
+        self.assertEqual(order(queue), ["b", "c", "a"])
+
+        # Promoted items stay in front through pushes and policy changes.
+        queue.push("c", summary(size=1000))
+        queue.reprioritize(transfer_queue.FIFO, lambda item: 1)
+        self.assertEqual(order(queue), ["b", "c", "a"])
+        self.assertEqual(queue.pop()[0], "b")
+        self.assertEqual(queue.pop()[0], "c")
+        self.assertEqual(queue.promoted, {})
+
+    def test_pop(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.FIFO)
+        self.assertEqual(queue.pop(), None)
+        for item in ("a", "b", "c"):
+            queue.push(item, summary())
+        queue.discard("a")
+
+        # Items passed over keep their place.
+        self.assertEqual(queue.pop(lambda item: item == "c")[0], "c")
+        self.assertEqual(queue.pop(lambda item: False), None)
+        self.assertEqual(queue.pop()[0], "b")
+        self.assertEqual(len(queue), 0)
+
+    def test_remap(self):
+        queue = transfer_queue.TransferQueue(transfer_queue.FIFO)
+        for item in ((0, "a"), (1, "b"), (2, "c")):
+            queue.push(item, summary())
+        queue.remap(lambda item: None if item[0] == 1 else (item[0] * 10, item[1]))
+        self.assertEqual(order(queue), [(0, "a"), (20, "c")])
+        self.assertTrue((20, "c") in queue)
+        self.assertEqual(queue.upcoming(1), [(0, "a")])
+
+if __name__ == "__main__":
+    unittest.main()